@@ -0,0 +1,277 @@
+'''
+Benchmarks of the hot paths on synthetic Body Level data of any size:
+    python Benchmark.py --rows 10000 100000 1000000 --output benchmark.json --baseline baseline.json
+- read_data for every encode mode
+- handle_class_imbalance for every method
+- CorrelationMatrix (numerical, categorical and mixed matrices)
+- ModelAnalysis.cross_validation
+- ModelScoring predict (NumPy-only and sklearn forms of the registry model) and the whole scoring pipeline
+The synthetic rows are drawn per Body Level from the class priors, the per-class means and stds of the numerical features
+and the per-class frequencies of the categories of DataFiles/dataset.csv. They are generated once per size (and seed) and
+kept in Saved/Cache/Benchmarks.
+Each case runs in a fresh process whose Saved/ is a temporary directory (so fitted preprocessors are never overwritten),
+after an untimed setup (e.g. reading the data a resampler works on). The wall time is the best of --repeat runs and the
+peak RSS is the high-water mark of the process (setup_rss_mb is the one reached by the setup alone).
+Results are written as JSON and compared with a stored baseline: a case slower or bigger than it by more than --tolerance
+is reported as a regression and the exit status is 1. Baselines depend on the machine, so regenerate them with
+--save-baseline on the machine the comparisons run on.
+'''
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..'))
+from DataPreparation.Schema import TARGET, CATEGORICAL, NUMERICAL, MIXED, CATEGORIES
+
+DATASET = os.path.join(HERE, '../DataFiles/dataset.csv')
+DATA_DIR = os.path.join(HERE, '../Saved/Cache/Benchmarks')
+# slowdowns smaller than this (in seconds) are timer noise, never regressions
+MIN_SLOWDOWN = 0.01
+
+
+#---------------------------------------------------------------------------------
+# Synthetic data
+
+def fit_generator(path=DATASET):
+    '''
+    The class priors, the per-class means and stds of the numerical features (with their overall range) and the per-class
+    frequencies of the categories (smoothed so every category can occur) of the dataset.
+    '''
+    ds = pd.read_csv(path)
+    levels = sorted(ds[TARGET].unique())
+    groups = [ds[ds[TARGET] == level] for level in levels]
+    return {
+        'levels': np.array(levels),
+        'priors': np.array([len(group) for group in groups]) / len(ds),
+        'means': np.array([group[NUMERICAL].mean().to_numpy() for group in groups]),
+        'stds': np.array([group[NUMERICAL].std().to_numpy() for group in groups]),
+        'ranges': (ds[NUMERICAL].min().to_numpy(), ds[NUMERICAL].max().to_numpy()),
+        'frequencies': {feat: np.array([(group[feat].value_counts().reindex(CATEGORIES[feat]).fillna(0).to_numpy() + 1) /
+                                        (len(group) + len(CATEGORIES[feat])) for group in groups]) for feat in CATEGORICAL},
+    }
+
+
+def synthetic_chunk(generator, n_rows, rng):
+    '''
+    n_rows synthetic rows with the columns of the dataset (in its order).
+    '''
+    y = rng.choice(len(generator['levels']), n_rows, p=generator['priors'])
+    low, high = generator['ranges']
+    numerical = np.clip(rng.normal(generator['means'][y], generator['stds'][y]), low, high)
+    columns = {feat: numerical[:, j] for j, feat in enumerate(NUMERICAL)}
+    for feat in CATEGORICAL:
+        # inverse transform sampling of each row's category from the frequencies of its class
+        cumulative = generator['frequencies'][feat].cumsum(axis=1)[y]
+        codes = (rng.random((n_rows, 1)) > cumulative[:, :-1]).sum(axis=1)
+        columns[feat] = np.array(CATEGORIES[feat])[codes]
+    columns[TARGET] = generator['levels'][y]
+    return pd.DataFrame(columns)[MIXED + [TARGET]]
+
+
+def synthetic_path(n_rows, seed=0, chunksize=1_000_000):
+    '''
+    The path of a csv file of n_rows synthetic rows, generated (chunk by chunk) the first time it is asked for.
+    '''
+    path = os.path.join(DATA_DIR, f'synthetic-{n_rows}-{seed}.csv')
+    if os.path.isfile(path): return path
+    os.makedirs(DATA_DIR, exist_ok=True)
+    generator, rng = fit_generator(), np.random.default_rng(seed)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    for start in range(0, n_rows, chunksize):
+        chunk = synthetic_chunk(generator, min(chunksize, n_rows - start), rng)
+        chunk.to_csv(tmp_path, mode='w' if start == 0 else 'a', header=start == 0, index=False, float_format='%.6f')
+    os.replace(tmp_path, path)
+    return path
+
+
+#---------------------------------------------------------------------------------
+# Cases: each one does its setup on the csv file at path and returns the function to time
+
+def read_data_case(path, encode):
+    from DataPreparation.DataPreparation import read_data
+    return lambda: read_data(encode=encode, split='train', path=path, cache=False)
+
+# the features each resampling method works on and the largest number of rows it is run on
+# (SMOTEN and SMOTENC take quadratic time, and SMOTEN quadratic memory, in the number of rows)
+RESAMPLING = {'SMOTE': ('Numerical', 1_000_000), 'BorderlineSMOTE': ('Numerical', 1_000_000), 'SMOTEN': ('Categorical', 10_000),
+              'SMOTENC': (None, 10_000), 'Under Sampling': (None, None), 'Cost Sensitive': (None, None)}
+
+def resampling_case(path, method):
+    from DataPreparation.DataPreparation import read_data
+    from HandleClassImbalance.HandleClassImbalance import handle_class_imbalance
+    x_data, y_data = read_data(RESAMPLING[method][0], split='train', path=path, cache=False)
+    def run():
+        result = handle_class_imbalance(x_data, y_data, method, k=5, sampling_ratio=[1, 1, 1])
+        # handle_class_imbalance gives the data back untouched when it can not apply the method
+        if method != 'Cost Sensitive' and result[0] is x_data: raise ValueError(f'{method} did not resample the data')
+    return run
+
+def correlation_case(path):
+    from DataPreparation.DataPreparation import read_data
+    from DataPreparation.CovarianceAnalysis import CorrelationMatrix
+    x_data, _ = read_data(split='train', path=path, standardize=False, cache=False)
+    def run():
+        matrix = CorrelationMatrix(x_data)
+        matrix.numerical_correlation_matrix(), matrix.categorical_correlation_matrix(), matrix.mix_correlation_matrix()
+    return run
+
+def cross_validation_case(path):
+    from sklearn.linear_model import LogisticRegression
+    from DataPreparation.DataPreparation import read_data
+    from ModelPipelines.ModelAnalysis import cross_validation
+    x_data, y_data = read_data('Numerical', split='train', path=path, cache=False)
+    return lambda: cross_validation(LogisticRegression(max_iter=1000), x_data, y_data, k=[5], n_repeats=[1])
+
+def predict_case(path, lean):
+    from ModelScoring.Pipeline import HERE, MODEL, load_model, load_preprocessor, read_sample, predict
+    model = load_model(MODEL, lean=lean)
+    x_test = read_sample(load_preprocessor(os.path.join(HERE, 'Preprocessor')), path)
+    return lambda: predict(model, x_test)
+
+def pipeline_case(path):
+    from ModelScoring.Pipeline import pipeline
+    return lambda: pipeline(path, output_path=os.devnull)
+
+# name: (case, its arguments, the largest number of rows it is run on)
+CASES = {
+    **{f'read_data[{encode}]': (read_data_case, {'encode': encode}, None) for encode in (None, 'Label', 'OneHot', 'Frequency')},
+    **{f'handle_class_imbalance[{method}]': (resampling_case, {'method': method}, max_rows)
+       for method, (_, max_rows) in RESAMPLING.items()},
+    'CorrelationMatrix': (correlation_case, {}, None),
+    'cross_validation': (cross_validation_case, {}, None),
+    'predict[lean]': (predict_case, {'lean': True}, None),
+    'predict[sklearn]': (predict_case, {'lean': False}, None),
+    'pipeline': (pipeline_case, {}, None),
+}
+
+
+#---------------------------------------------------------------------------------
+# Runner
+
+def peak_rss_mb():
+    # on Linux, ru_maxrss survives exec (a spawned process would start with the peak of its parent) but VmHWM does not
+    if os.path.isfile('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'): return int(line.split()[1]) / 2**10
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def measure(name, path, rows, repeat, results):
+    '''
+    Runs the case name on path in this (fresh) process and puts its measurements in the results queue.
+    '''
+    try:
+        case, kwargs, _ = CASES[name]
+        run = case(path, **kwargs)
+        setup_rss = peak_rss_mb()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        wall = min(times)
+        results.put({'case': name, 'rows': rows, 'wall_s': wall, 'rows_per_s': rows / wall, 'peak_rss_mb': peak_rss_mb(),
+                     'setup_rss_mb': setup_rss, 'times_s': times})
+    except Exception as error:
+        results.put({'case': name, 'rows': rows, 'error': repr(error)})
+
+
+def run_benchmarks(rows=(10_000,), cases='.', repeat=3, seed=0):
+    '''
+    Runs every case whose name matches the regular expression cases on synthetic data of each number of rows.
+    Returns the list of measurements (a measurement with an 'error' instead if the case failed).
+    '''
+    context = multiprocessing.get_context('spawn')
+    saved = tempfile.mkdtemp(prefix='benchmark-saved-')
+    os.environ['BODY_LEVEL_REGISTRY'] = saved
+    # register the competition model once so no case times (or counts the memory of) its conversion
+    from ModelScoring import Registry
+    from ModelScoring.Pipeline import MODEL
+    Registry.register(MODEL, saved)
+    results = []
+    try:
+        for n_rows in rows:
+            path = synthetic_path(n_rows, seed)
+            for name, (_, _, max_rows) in CASES.items():
+                if not re.search(cases, name) or (max_rows is not None and n_rows > max_rows): continue
+                queue = context.Queue()
+                process = context.Process(target=measure, args=(name, path, n_rows, repeat, queue))
+                process.start()
+                process.join()
+                result = queue.get() if not queue.empty() else {'case': name, 'rows': n_rows, 'error': f'exit code {process.exitcode}'}
+                results.append(result)
+                if 'error' in result: print(f'{name:<45} {n_rows:>10} rows  FAILED {result["error"]}')
+                else: print(f'{name:<45} {n_rows:>10} rows  {result["wall_s"]:9.3f}s  {result["rows_per_s"]:12.0f} rows/s  {result["peak_rss_mb"]:8.1f} MB')
+    finally:
+        del os.environ['BODY_LEVEL_REGISTRY']
+        shutil.rmtree(saved, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''
+    Adds the ratio of the wall time and of the peak RSS of each result to those of the baseline for the same case and rows,
+    and returns the regressions: results that are more than tolerance slower or bigger, or that failed where the baseline did not.
+    '''
+    reference = {(result['case'], result['rows']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        base = reference.get((result['case'], result['rows']))
+        if base is None or 'error' in base: continue
+        if 'error' in result:
+            regressions.append({'case': result['case'], 'rows': result['rows'], 'error': result['error']})
+            continue
+        for metric in ('wall_s', 'peak_rss_mb'):
+            ratio = result[metric] / base[metric]
+            result[f'{metric}_vs_baseline'] = ratio
+            if ratio > 1 + tolerance and (metric != 'wall_s' or result[metric] - base[metric] > MIN_SLOWDOWN):
+                regressions.append({'case': result['case'], 'rows': result['rows'], 'metric': metric,
+                                    'value': result[metric], 'baseline': base[metric], 'ratio': ratio})
+    return regressions
+
+
+def machine():
+    import sklearn
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__, 'sklearn': sklearn.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic Body Level data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000], help='sizes of the synthetic datasets (up to 10M)')
+    parser.add_argument('--cases', default='.', help='regular expression selecting the cases to run')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each case (the best one is kept)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--output', default='benchmark.json', help='where to write the results')
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'baseline.json'), help='results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown (or memory growth) reported as a regression')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline instead of comparing')
+    args = parser.parse_args()
+
+    report = {'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'), 'machine': machine(),
+              'repeat': args.repeat, 'seed': args.seed, 'results': run_benchmarks(args.rows, args.cases, args.repeat, args.seed)}
+    regressions = []
+    if not args.save_baseline and os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(report['results'], json.load(f), args.tolerance)
+        report['baseline'], report['regressions'] = os.path.abspath(args.baseline), regressions
+    with open(args.baseline if args.save_baseline else args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    for regression in regressions:
+        print('REGRESSION', json.dumps(regression))
+    sys.exit(1 if regressions else 0)
@@ -2,14 +2,22 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import seaborn as sns
-import scipy.stats as ss
+import scipy.sparse as sp
+from concurrent.futures import ProcessPoolExecutor
+from DataPreparation.Schema import CATEGORICAL, CATEGORIES, MIXED, categorical_features, numerical_features
 
 
 class CorrelationMatrix:
     def __init__(self, x_data):
         self.x_data = x_data
-        self.disc_feats = [feat for feat in x_data.columns if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) == str]
-        self.cont_feats = [feat for feat in x_data.columns if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) != str]
+        self.disc_feats = categorical_features(x_data)
+        self.cont_feats = numerical_features(x_data)
+
+    def statistics(self, codebooks=None):
+        '''
+        returns the mergeable sufficient statistics of x_data (see CorrelationStatistics), e.g. to keep them up to date as new rows arrive.
+        '''
+        return CorrelationStatistics(self.disc_feats, self.cont_feats, codebooks).update(self.x_data)
 
     def numerical_correlation_matrix(self):
         '''
@@ -22,23 +30,92 @@ class CorrelationMatrix:
     def categorical_correlation_matrix(self):
         '''
         Calculate a correlation matrix for the categorical features in the dataset
+        Every feature is integer-coded once and the contingency tables of feature i against all features j >= i are
+        counted with a single bincount; the matrix is symmetric so only the upper triangle is computed.
         '''
-        x_data_disc = self.x_data[self.disc_feats]
+        codes, levels = self.category_codes()
         corr = np.zeros((len(self.disc_feats), len(self.disc_feats)))
         for i in range(len(self.disc_feats)):
-            for j in range(len(self.disc_feats)):
-                corr[i, j] = self.cramers_v(x_data_disc, self.disc_feats[i], self.disc_feats[j])
+            for j, table in enumerate(self.contingency_tables(codes, levels, i), start=i):
+                corr[i, j] = corr[j, i] = self.cramers_v_from_table(table)
         return corr
 
     def mix_correlation_matrix(self):
         '''
         Calculate a correlation matrix for the categorical and continuous features in the dataset
+        The group sums of all continuous features for all categories are obtained at once as one sparse matrix product.
         '''
-        corr = np.zeros((len(self.disc_feats), len(self.cont_feats)))
-        for i in range(len(self.disc_feats)):
-            for j in range(len(self.cont_feats)):
-                corr[i, j] = self.correlation_ratio(self.x_data, self.disc_feats[i], self.cont_feats[j])
-        return corr
+        codes, levels = self.category_codes()
+        values = self.x_data[self.cont_feats].to_numpy(dtype=np.float64)
+        return self.correlation_ratios(codes, levels, values)
+
+    def category_codes(self):
+        '''
+        Integer-code every categorical feature once.
+        Returns an (n, d) matrix of codes (-1 for missing values) and the number of observed values of each feature.
+        '''
+        codes = np.empty((len(self.x_data), len(self.disc_feats)), dtype=np.int64)
+        levels = np.empty(len(self.disc_feats), dtype=np.int64)
+        for j, feat in enumerate(self.disc_feats):
+            codes[:, j], uniques = pd.factorize(self.x_data[feat])
+            levels[j] = len(uniques)
+        return codes, levels
+
+    @staticmethod
+    def contingency_tables(codes, levels, i, max_cells=2**24):
+        '''
+        Returns the contingency tables of feature i against every feature j >= i (in order).
+        Each pair gets its own range of bins (offset + code_i * levels_j + code_j) so one bincount counts a whole
+        block of pairs; blocks are sized so that at most max_cells combined codes are held at once.
+        Rows where either feature is missing are left out of a pair, like pd.crosstab does.
+        '''
+        n, d = codes.shape
+        block = max(1, max_cells // max(n, 1))
+        tables = []
+        for lo in range(i, d, block):
+            hi = min(lo + block, d)
+            sizes = levels[i] * levels[lo:hi]
+            offsets = np.concatenate([[0], np.cumsum(sizes)])
+            combined = offsets[:-1] + codes[:, [i]] * levels[lo:hi] + codes[:, lo:hi]
+            known = (codes[:, [i]] >= 0) & (codes[:, lo:hi] >= 0)
+            counts = np.bincount(combined[known], minlength=offsets[-1])
+            tables += [counts[offsets[j]:offsets[j+1]].reshape(levels[i], levels[lo+j]) for j in range(hi - lo)]
+        return tables
+
+    @staticmethod
+    def chi2(observed):
+        '''
+        Pearson's chi-squared statistic of a contingency table, as ss.chi2_contingency computes it
+        (with Yates' correction when there is a single degree of freedom).
+        '''
+        n = observed.sum()
+        expected = np.outer(observed.sum(axis=1), observed.sum(axis=0)) / n
+        dof = (observed.shape[0] - 1) * (observed.shape[1] - 1)
+        if dof == 0:
+            return 0.0
+        difference = np.abs(observed - expected)
+        if dof == 1:
+            difference = difference - np.minimum(0.5, difference)
+        return (difference**2 / expected).sum()
+
+    @staticmethod
+    def cramers_v_from_table(confusion_matrix):
+        '''
+        Cramers V statistic (with bias correction) from the contingency table of two categorical features.
+        '''
+        # values that never occur together with a value of the other feature are not part of the table
+        confusion_matrix = confusion_matrix[confusion_matrix.any(axis=1)][:, confusion_matrix.any(axis=0)]
+        n = confusion_matrix.sum()
+        if n == 0:
+            return np.nan
+        chi2 = CorrelationMatrix.chi2(confusion_matrix)
+        phi2 = chi2 / n
+        r, k = confusion_matrix.shape
+        with np.errstate(divide='ignore', invalid='ignore'):
+            phi2corr = max(0, phi2 - ((k-1)*(r-1))/(n-1))
+            rcorr = r - ((r-1)**2)/(n-1)
+            kcorr = k - ((k-1)**2)/(n-1)
+            return np.sqrt(phi2corr / min((kcorr-1), (rcorr-1)))
 
     def cramers_v(self, data, col1, col2):
         '''
@@ -46,15 +123,31 @@ class CorrelationMatrix:
         Like lift from Big data but more sophisticated.
         This was modified from SO: https://stackoverflow.com/questions/46498455/categorical-features-correlation/46498792#46498792
         '''
-        confusion_matrix = pd.crosstab(data[col1], data[col2]).values
-        chi2 = ss.chi2_contingency(confusion_matrix)[0]
-        n = confusion_matrix.sum()
-        phi2 = chi2 / n
-        r, k = confusion_matrix.shape
-        phi2corr = max(0, phi2 - ((k-1)*(r-1))/(n-1))
-        rcorr = r - ((r-1)**2)/(n-1)
-        kcorr = k - ((k-1)**2)/(n-1)
-        return np.sqrt(phi2corr / min((kcorr-1), (rcorr-1)))
+        codes = np.stack([pd.factorize(data[col1])[0], pd.factorize(data[col2])[0]], axis=1)
+        levels = codes.max(axis=0) + 1
+        return self.cramers_v_from_table(self.contingency_tables(codes, levels, 0)[1])
+
+    @staticmethod
+    def correlation_ratios(codes, levels, values):
+        '''
+        The correlation ratio of every categorical feature (integer-coded) with every continuous feature (columns of values).
+        The values are centered once, so the weighted variance of the group means is sum(group_sum**2 / group_size).
+        '''
+        n, d = codes.shape
+        values = values - values.mean(axis=0)
+        total_variance = (values**2).sum(axis=0)
+        # one indicator row per (feature, category): its product with the values gives all the group sums
+        offsets = np.concatenate([[0], np.cumsum(levels)])
+        known = codes >= 0
+        groups = (codes + offsets[:-1])[known]
+        rows = np.broadcast_to(np.arange(n)[:, None], codes.shape)[known]
+        indicator = sp.csr_matrix((np.ones(len(groups)), (groups, rows)), shape=(offsets[-1], n))
+        group_sums = indicator @ values
+        group_sizes = np.bincount(groups, minlength=offsets[-1])
+        group_variances = np.zeros((d, values.shape[1]))
+        np.add.at(group_variances, np.repeat(np.arange(d), levels), group_sums**2 / np.maximum(group_sizes, 1)[:, None])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (group_variances / total_variance)**.5
 
     def correlation_ratio(self, x_data, col1, col2):
         '''
@@ -67,14 +160,9 @@ class CorrelationMatrix:
         It asks the question: If the category changes are the values of the continuous variable on average different?
         If this is zero then the average is the same over all categories so there is no association.
         '''
-        categories = np.array(x_data[col1])
-        values = np.array(x_data[col2])
-        group_variances = 0
-        for category in set(categories):
-            group = values[np.where(categories == category)[0]]
-            group_variances += len(group)*(np.mean(group)-np.mean(values))**2
-        total_variance = sum((values-np.mean(values))**2)
-        return (group_variances / total_variance)**.5
+        codes, uniques = pd.factorize(x_data[col1])
+        values = np.asarray(x_data[col2], dtype=np.float64)
+        return self.correlation_ratios(codes[:, None], np.array([len(uniques)]), values[:, None])[0, 0]
 
     def plot_correlation_matrices(self):
         '''
@@ -140,3 +228,141 @@ class CorrelationMatrix:
 
         plt.show()
 
+
+def update_from_chunk(statistics, path, header, offset, chunksize, features):
+    # worker task of CorrelationStatistics.from_csv (module level so it can be pickled)
+    from DataPreparation.DataPreparation import read_chunk
+    return statistics.update(read_chunk(path, header, offset, chunksize, features))
+
+
+class CorrelationStatistics:
+    '''
+    Mergeable sufficient statistics of the three correlation matrices, so they can be computed over data that does not fit in memory:
+    - the count, means and co-moment matrix of the numerical features (Pearson correlation)
+    - the counts of every pair of categories of the categorical features (Cramers V); stacked as one matrix where the block (i, j)
+      is the contingency table of features i and j
+    - the count and the mean of every numerical feature within every category (correlation ratio)
+    Statistics of different chunks (or workers) are combined with merge, and the matrices are read off them at any time.
+    Categories are coded with fixed codebooks (the schema's by default), values outside them count as missing.
+    Rows with a missing numerical value are left out of the numerical and mixed statistics.
+    '''
+    def __init__(self, disc_feats, cont_feats, codebooks=None):
+        self.disc_feats = list(disc_feats)
+        self.cont_feats = list(cont_feats)
+        self.codebooks = {feat: list((codebooks or CATEGORIES)[feat]) for feat in self.disc_feats}
+        self.levels = np.array([len(self.codebooks[feat]) for feat in self.disc_feats], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.levels)]).astype(np.int64)
+        n_levels, n_cont = self.offsets[-1], len(self.cont_feats)
+        self.count = 0
+        self.mean = np.zeros(n_cont)
+        self.comoments = np.zeros((n_cont, n_cont))
+        self.pair_counts = np.zeros((n_levels, n_levels), dtype=np.int64)
+        self.group_counts = np.zeros(n_levels, dtype=np.int64)
+        self.group_means = np.zeros((n_levels, n_cont))
+
+    def empty(self):
+        return CorrelationStatistics(self.disc_feats, self.cont_feats, self.codebooks)
+
+    def indicator(self, codes):
+        '''
+        The sparse (n, levels) matrix with a one in the column of every category of every row.
+        '''
+        known = codes >= 0
+        rows = np.broadcast_to(np.arange(len(codes))[:, None], codes.shape)[known]
+        cols = (codes + self.offsets[:-1])[known]
+        return sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(codes), self.offsets[-1]))
+
+    def update(self, x_data):
+        '''
+        Add the rows of a chunk (a frame with the features of the statistics) to the statistics.
+        '''
+        codes = np.empty((len(x_data), len(self.disc_feats)), dtype=np.int64)
+        for j, feat in enumerate(self.disc_feats):
+            codes[:, j] = pd.Categorical(x_data[feat], categories=self.codebooks[feat]).codes
+        values = x_data[self.cont_feats].to_numpy(dtype=np.float64)
+        complete = ~np.isnan(values).any(axis=1)
+        indicator = self.indicator(codes)
+        pair_counts = (indicator.T @ indicator).toarray().astype(np.int64)
+
+        # the statistics of the chunk on its own (centered on the chunk means), then merged in
+        chunk = self.empty()
+        chunk.pair_counts = pair_counts
+        values, indicator = values[complete], indicator[complete]
+        chunk.count = len(values)
+        if chunk.count > 0:
+            chunk.mean = values.mean(axis=0)
+            centered = values - chunk.mean
+            chunk.comoments = centered.T @ centered
+            chunk.group_counts = np.asarray(indicator.sum(axis=0)).ravel().astype(np.int64)
+            chunk.group_means = (indicator.T @ values) / np.maximum(chunk.group_counts, 1)[:, None]
+        return self.merge(chunk)
+
+    def merge(self, other):
+        '''
+        Combine the statistics of other (computed over different rows) into these ones (Chan et al. update for the co-moments).
+        '''
+        count = self.count + other.count
+        if other.count > 0:
+            delta = other.mean - self.mean
+            self.comoments = self.comoments + other.comoments + np.outer(delta, delta) * self.count * other.count / count
+            self.mean = self.mean + delta * other.count / count
+        group_counts = self.group_counts + other.group_counts
+        weights = (other.group_counts / np.maximum(group_counts, 1))[:, None]
+        self.group_means = self.group_means + (other.group_means - self.group_means) * weights
+        self.group_counts = group_counts
+        self.pair_counts = self.pair_counts + other.pair_counts
+        self.count = count
+        return self
+
+    @classmethod
+    def from_csv(cls, path, features=MIXED, chunksize=100_000, n_jobs=None, codebooks=None):
+        '''
+        Accumulates the statistics of a csv file chunk by chunk. With n_jobs > 1 the chunks are shared among worker processes
+        whose partial statistics are merged at the end.
+        '''
+        from DataPreparation.DataPreparation import chunk_offsets, read_chunk
+        header, offsets = chunk_offsets(path, chunksize)
+        disc_feats = [feat for feat in header if feat in features and feat in CATEGORICAL]
+        cont_feats = [feat for feat in header if feat in features and feat not in CATEGORICAL]
+        statistics = cls(disc_feats, cont_feats, codebooks)
+        if n_jobs is None or n_jobs == 1:
+            for offset in offsets:
+                statistics.update(read_chunk(path, header, offset, chunksize, features))
+            return statistics
+        with ProcessPoolExecutor(n_jobs) as executor:
+            futures = [executor.submit(update_from_chunk, statistics.empty(), path, header, offset, chunksize, features) for offset in offsets]
+            for future in futures:
+                statistics.merge(future.result())
+        return statistics
+
+    def numerical_correlation_matrix(self):
+        '''
+        The Pearson correlation matrix of the numerical features (as DataFrame.corr would give).
+        '''
+        std = np.sqrt(np.diag(self.comoments))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = self.comoments / np.outer(std, std)
+        return pd.DataFrame(corr, index=self.cont_feats, columns=self.cont_feats)
+
+    def categorical_correlation_matrix(self):
+        '''
+        The Cramers V matrix of the categorical features, read off the stacked contingency tables (upper triangle only).
+        '''
+        corr = np.zeros((len(self.disc_feats), len(self.disc_feats)))
+        o = self.offsets
+        for i in range(len(self.disc_feats)):
+            for j in range(i, len(self.disc_feats)):
+                corr[i, j] = corr[j, i] = CorrelationMatrix.cramers_v_from_table(self.pair_counts[o[i]:o[i+1], o[j]:o[j+1]])
+        return corr
+
+    def mix_correlation_matrix(self):
+        '''
+        The correlation ratio of every categorical feature with every numerical feature, from the means within each category.
+        '''
+        between = self.group_counts[:, None] * (self.group_means - self.mean)**2
+        group_variances = np.zeros((len(self.disc_feats), len(self.cont_feats)))
+        np.add.at(group_variances, np.repeat(np.arange(len(self.disc_feats)), self.levels), between)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (group_variances / np.diag(self.comoments))**.5
+
+    plot_correlation_matrices = CorrelationMatrix.plot_correlation_matrices
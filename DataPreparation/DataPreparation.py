@@ -1,4 +1,6 @@
 import os
+import hashlib
+import json
 import matplotlib.pyplot as plt
 import itertools
 import pandas as pd
@@ -8,13 +10,24 @@ from IPython.display import display, HTML, Markdown, Latex
 import sys
 sys.path.append('../')
 from utils import nice_table
+from DataPreparation.Preprocessor import Preprocessor, RunningMoments
+from DataPreparation.Encoder import Encoder
+from DataPreparation.Schema import TARGET, CATEGORICAL, NUMERICAL, MIXED, CATEGORIES, dtypes, read_csv, categorical_features, numerical_features
 
+# fitted preprocessors and cached datasets go to Saved/ unless BODY_LEVEL_REGISTRY points elsewhere (as for the model registry)
+SAVED = os.path.abspath(os.environ.get('BODY_LEVEL_REGISTRY', os.path.join(os.path.dirname(os.path.abspath(__file__)), '../Saved')))
 
-def read_data(kind=None, encode=None, split="all", standardize=True ,**kwargs):
+
+def preprocessor_path(kind=None, encode=None):
     '''
-    reads the dataset from the folder and return it. 
-    If kind is specified, it returns only the categorical or numerical features.
-    dummy is a boolean that specifies if the categorical features should be one-hot encoded into numerical features.
+    returns the directory where the preprocessor fitted by read_data for the given kind and encoding is saved.
+    '''
+    return os.path.join(SAVED, f'Preprocessor-{kind or "All"}-{encode or "None"}')
+
+
+def split_path(split="all"):
+    '''
+    returns the path of the csv file that holds the given split.
     '''
     module_dir = os.path.dirname(__file__)
     if split == "train":    path = os.path.join(module_dir, '../DataFiles/train.csv')
@@ -22,68 +35,241 @@ def read_data(kind=None, encode=None, split="all", standardize=True ,**kwargs):
     elif split == "test":    path = os.path.join(module_dir, '../DataFiles/test.csv')
     elif split == "all":    path = os.path.join(module_dir, '../DataFiles/dataset.csv')
     elif split == "all-test":   path = os.path.join(module_dir, '../DataFiles/dataset-with-test.csv')
+    return path
+
+
+# bump whenever read_data changes the way it prepares the data so that old cache entries are ignored
+CACHE_VERSION = 2
+_file_hashes = {}
+
+
+def file_hash(path):
+    '''
+    returns the sha1 of the content of the file (remembered while the file's size and modification time do not change).
+    '''
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        _file_hashes[key] = sha.hexdigest()
+    return _file_hashes[key]
+
+
+def preprocessor_hash(kind=None, encode=None):
+    '''
+    returns the sha1 of the files of the preprocessor saved for the given kind and encoding (None if there is none).
+    '''
+    path = preprocessor_path(kind, encode)
+    files = [os.path.join(path, file) for file in ('preprocessor.json', 'means.npy', 'stds.npy')]
+    if not all(os.path.isfile(file) for file in files): return None
+    return hashlib.sha1(''.join(file_hash(file) for file in files).encode()).hexdigest()
+
+
+def save_cached(path, x_data, y_data):
+    '''
+    saves x_data and y_data column by column into an uncompressed .npz file (categorical columns are stored as codes).
+    '''
+    arrays, meta = {'index': x_data.index.to_numpy(), 'y': np.asarray(y_data)}, {'columns': list(x_data.columns), 'categories': {}}
+    for i, feat in enumerate(x_data.columns):
+        if isinstance(x_data[feat].dtype, pd.CategoricalDtype):
+            arrays[f'col{i}'] = x_data[feat].cat.codes.to_numpy()
+            meta['categories'][feat] = x_data[feat].cat.categories.tolist()
+        else:
+            arrays[f'col{i}'] = x_data[feat].to_numpy()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first so a concurrent reader never sees a partial file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_cached(path):
+    '''
+    loads x_data and y_data saved by save_cached.
+    '''
+    with np.load(path, allow_pickle=False) as npz:
+        meta = json.loads(str(npz['meta']))
+        columns = {}
+        for i, feat in enumerate(meta['columns']):
+            if feat in meta['categories']:
+                columns[feat] = pd.Categorical.from_codes(npz[f'col{i}'], meta['categories'][feat])
+            else:
+                columns[feat] = npz[f'col{i}']
+        x_data = pd.DataFrame(columns, index=npz['index'])
+        y_data = npz['y']
+    return x_data, y_data
+
+
+def read_data(kind=None, encode=None, split="all", standardize=True, cache=True, path=None, **kwargs):
+    '''
+    reads the dataset from the folder and return it. 
+    If kind is specified, it returns only the categorical or numerical features.
+    dummy is a boolean that specifies if the categorical features should be one-hot encoded into numerical features.
+    If cache is true, the result is saved to and reused from Saved/Cache keyed by the hash of the csv file and the arguments
+    (and, for the splits that reuse the saved preprocessor, the hash of its files), so editing the csv file or refitting the
+    preprocessor invalidates it. The splits that fit the preprocessor cache it too and save it again on a hit, so the one
+    val/test reuse is always that of the last train/all split read, cached or not.
+    path reads another csv file with the same columns (e.g. a bigger sample) instead of the one of the split; the split
+    still decides whether the preprocessor is fitted or reused.
+    '''
+    path = path or split_path(split)
     
-    ds = pd.read_csv(path)
+    # train/all fit (and save) the preprocessor while val/test reuse the saved one
+    fits_preprocessor = standardize and split=="train" or split=="all"
+    loads_preprocessor = not fits_preprocessor and (standardize and split=="val" or split=="test")
+    
+    if cache:
+        # val/test are transformed with the preprocessor fitted on train, so they are only valid for that very preprocessor
+        fitted = preprocessor_hash(kind, encode) if loads_preprocessor else None
+        key = hashlib.sha1(json.dumps([CACHE_VERSION, file_hash(path), kind, encode, split, standardize, fitted]).encode()).hexdigest()
+        cache_path = os.path.join(SAVED, 'Cache', f'{key}.npz')
+        cached_preprocessor = os.path.join(SAVED, 'Cache', f'{key}-preprocessor')
+        if os.path.isfile(cache_path) and (not fits_preprocessor or os.path.isdir(cached_preprocessor)):
+            # train and all save their preprocessor to the same place, so the one of this split is put back
+            if fits_preprocessor: Preprocessor.load(cached_preprocessor, mmap_mode=None).save(preprocessor_path(kind, encode))
+            return load_cached(cache_path)
+    
+    # parse only the needed features, already typed according to the schema
+    features = {"Categorical": CATEGORICAL, "Numerical": NUMERICAL}.get(kind, MIXED)
+    ds = read_csv(path, features)
     # sort ds by Body_Level
-    ds = ds.sort_values(by=['Body_Level'])
+    ds = ds.sort_values(by=[TARGET])
     # Body_Level goes to y_data
-    y_data = ds['Body_Level']
+    y_data = ds[TARGET]
     # convert y_data to integer labels
     y_data = pd.factorize(y_data)[0]
     
     # all columns except Body_Level go to x_data
-    x_data = ds.drop('Body_Level', axis=1)
+    x_data = ds.drop(TARGET, axis=1)
     
-    if kind == "Categorical":
-        # extract only the categorical features
-        disc_feats = [feat for feat in x_data.columns if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) == str]
-        x_data = x_data[disc_feats]
-        
-    elif kind == "Numerical":
-        # extract only the numerical features
-        cont_feats = [feat for feat in x_data.columns if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) != str]
-        x_data = x_data[cont_feats]
-        for feat in x_data.columns:
-            x_data[feat] = x_data[feat].astype(float)
-    
-    if encode=='Label':
-        # convert categorical features to integer labels
-        for feat in x_data.columns:
-            if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) == str:
-                    x_data[feat] = pd.factorize(x_data[feat])[0]
-    if encode=='OneHot':
-        # convert categorical features to one-hot encoded features
-        for feat in x_data.columns:
-            if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) == str:
-                x_data = pd.concat([x_data, pd.get_dummies(x_data[feat], prefix=feat)], axis=1)
-                x_data = x_data.drop(feat, axis=1)
-    if encode=='Frequency':
-        # convert categorical features to frequency encoded features
-        for feat in x_data.columns:
-            if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) == str:
-                x_data[feat] = x_data[feat].map(x_data[feat].value_counts())/len(x_data)
-    
-    if standardize and split=="train" or split=="all":
-        # standardize the numerical features
-        means, stds = [], []
-        for feat in x_data.columns:
-            if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) != str:
-                means.append(x_data[feat].mean())
-                stds.append(x_data[feat].std())
-                x_data[feat] = (x_data[feat] - x_data[feat].mean())/x_data[feat].std()
-        # save the means and stds for later use
-        np.save(os.path.join(module_dir, '../Saved') + '/means.npy', means)
-        np.save(os.path.join(module_dir, '../Saved') + '/stds.npy', stds)
-        
-    elif standardize and split=="val" or split=="test":
-        means = np.load(os.path.join(module_dir, '../Saved') + '/means.npy')
-        stds = np.load(os.path.join(module_dir, '../Saved') + '/stds.npy')
-        for i, feat in enumerate(x_data.columns):
-            if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) != str:
-                x_data[feat] = (x_data[feat] - means[i])/stds[i]
+    # the possible values of each categorical feature (kept by the preprocessor even after encoding)
+    disc_feats = categorical_features(x_data)
+    codebooks = {feat: CATEGORIES[feat] for feat in disc_feats}
+    
+    if loads_preprocessor:
+        preprocessor = Preprocessor.load(preprocessor_path(kind, encode))
+    
+    encoder = None
+    if encode in ['Label', 'OneHot', 'Frequency']:
+        # encode all categorical features at once (with the encoder fitted on the training data if there is one)
+        if loads_preprocessor and preprocessor.encoder is not None:   encoder = preprocessor.encoder
+        else:                                                           encoder = Encoder(encode, codebooks).fit(x_data)
+        x_data = encoder.transform_frame(x_data)
+    
+    if fits_preprocessor:
+        # fit the standardization statistics once and save them for later use
+        preprocessor = Preprocessor(encoder=encoder).fit(x_data, codebooks)
+        preprocessor.save(preprocessor_path(kind, encode))
+    
+    if fits_preprocessor or loads_preprocessor:
+        x_data = preprocessor.transform(x_data)
+    
+    if cache:
+        if fits_preprocessor: preprocessor.save(cached_preprocessor)
+        save_cached(cache_path, x_data, y_data)
         
     return x_data, y_data
 
+
+def chunk_offsets(path, chunksize=100_000):
+    '''
+    returns the csv header and the byte offset where each chunk of chunksize rows starts (rows must not contain newlines).
+    '''
+    offsets = []
+    with open(path, 'rb') as f:
+        header = f.readline().decode().strip().split(',')
+        offset = f.tell()
+        for i, line in enumerate(f):
+            if i % chunksize == 0: offsets.append(offset)
+            offset += len(line)
+    return header, offsets
+
+
+def read_chunk(path, header, offset, chunksize, features=MIXED):
+    '''
+    reads the chunk of at most chunksize rows that starts at the given byte offset, typed according to the schema.
+    '''
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return pd.read_csv(f, header=None, names=header, nrows=chunksize, dtype=dtypes(features),
+                           usecols=lambda col: col in features or col == TARGET)
+
+
+def fit_stream(kind=None, encode=None, split="train", chunksize=100_000):
+    '''
+    fits the preprocessor of read_data (encoder and standardization statistics) in a single streaming pass over the csv.
+    Numerical statistics are accumulated with Welford's algorithm; the statistics of encoded categorical features only
+    depend on how often each category occurs, so they are derived from the category counts at the end.
+    returns the preprocessor and the sorted target values (the label of a row is the index of its target in them).
+    '''
+    path = split_path(split)
+    features = {"Categorical": CATEGORICAL, "Numerical": NUMERICAL}.get(kind, MIXED)
+    header, offsets = chunk_offsets(path, chunksize)
+    disc_feats = [feat for feat in header if feat in features and feat in CATEGORICAL]
+    cont_feats = [feat for feat in header if feat in features and feat not in CATEGORICAL]
+    codebooks = {feat: CATEGORIES[feat] for feat in disc_feats}
+    
+    moments = RunningMoments(len(cont_feats))
+    # the last count of each feature is for values outside the codebook
+    counts = {feat: np.zeros(len(codebooks[feat]) + 1, dtype=np.int64) for feat in disc_feats}
+    classes = set()
+    for offset in offsets:
+        chunk = read_chunk(path, header, offset, chunksize, features)
+        moments.update(chunk[cont_feats].to_numpy(dtype=np.float64))
+        for feat in disc_feats:
+            codes = chunk[feat].cat.codes.to_numpy()
+            counts[feat] += np.bincount(np.where(codes >= 0, codes, len(codebooks[feat])), minlength=len(codebooks[feat]) + 1)
+        classes.update(np.unique(chunk[TARGET]).tolist())
+    n = moments.count
+    
+    encoder = None
+    if encode in ['Label', 'OneHot', 'Frequency']:
+        encoder = Encoder(encode, codebooks, {feat: (counts[feat][:-1] / n).tolist() for feat in disc_feats})
+    
+    # mean and std of every output column
+    columns = [feat for feat in header if feat in features and feat != TARGET]
+    stats = {feat: (moments.mean[i], moments.std()[i]) for i, feat in enumerate(cont_feats)}
+    for feat in disc_feats if encoder is not None else []:
+        # encode one row per category (plus the unknown bucket) and weigh it by how often the category occurred
+        table = pd.DataFrame({feat: pd.Categorical(codebooks[feat] + [np.nan], categories=codebooks[feat])})
+        values = encoder.transform(table).astype(np.float64)
+        mean = counts[feat] @ values / n
+        std = np.sqrt(counts[feat] @ (values - mean)**2 / (n - 1))
+        for name, m, sd in zip(encoder.get_feature_names_out([feat]), mean, std):
+            stats[name] = (m, sd)
+    out_columns = encoder.get_feature_names_out(columns) if encoder is not None else columns
+    numerical = [feat for feat in out_columns if feat in stats]
+    preprocessor = Preprocessor(out_columns, {feat: 'float64' if feat in stats else 'category' for feat in out_columns}, codebooks,
+                                numerical, [stats[feat][0] for feat in numerical], [stats[feat][1] for feat in numerical], encoder)
+    return preprocessor, np.array(sorted(classes))
+
+
+def read_batches(preprocessor, classes, kind=None, split="train", batch_size=1024, chunksize=100_000, shuffle=True, random_state=None):
+    '''
+    yields encoded and standardized (x_batch, y_batch) mini-batches from the csv without loading it whole.
+    If shuffle is true, the chunks are visited in a random order and the rows of each chunk are shuffled.
+    '''
+    path = split_path(split)
+    features = {"Categorical": CATEGORICAL, "Numerical": NUMERICAL}.get(kind, MIXED)
+    header, offsets = chunk_offsets(path, chunksize)
+    rng = np.random.default_rng(random_state)
+    order = rng.permutation(len(offsets)) if shuffle else np.arange(len(offsets))
+    for i in order:
+        chunk = read_chunk(path, header, offsets[i], chunksize, features)
+        y_chunk = np.searchsorted(classes, chunk[TARGET].to_numpy())
+        x_chunk = chunk.drop(TARGET, axis=1)
+        if preprocessor.encoder is not None:
+            x_chunk = preprocessor.encoder.transform_frame(x_chunk)
+        x_chunk = preprocessor.transform(x_chunk).to_numpy(dtype=np.float64)
+        rows = rng.permutation(len(x_chunk)) if shuffle else np.arange(len(x_chunk))
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            yield x_chunk[batch], y_chunk[batch]
+
     
 def basic_info(x_data, y_data):
     '''
@@ -124,10 +310,11 @@ def features_histograms(x_data):
     plt.style.use('dark_background')
     fig, axs = plt.subplots(4, 4, figsize=(20, 20))
     plt.rcParams['figure.dpi'] = 200
+    disc_feats = categorical_features(x_data)
     for i in range(4):
         for j in range(4):
             # check if its a categorical or numerical feature
-            if type(x_data.iloc[0, i*4+j]) == str:
+            if x_data.columns[i*4+j] in disc_feats:
                 # if categorical, plot a bar chart
                 names_num = x_data.iloc[:, i*4+j].value_counts().index
                 axs[i, j].bar(names_num, x_data.iloc[:, i*4+j].value_counts(), color='aqua', edgecolor='black', alpha=0.7)
@@ -144,8 +331,7 @@ def features_histograms(x_data):
     feats = {}
     c = 0
     for i in range(len(x_data.columns)):
-        feature_type = type(x_data.iloc[0, i])
-        if feature_type == str:
+        if x_data.columns[i] in disc_feats:
             feats[x_data.columns[i]] = str(len(x_data.iloc[:, i].unique()))
             c+=1
         else:
@@ -164,7 +350,7 @@ def visualize_continuous_data(x_data, y_data):
     Plot a 4x7 grid of scatter plots for each pair of continuous features.
     '''
     # get only the continuous features
-    cont_feats = [feat for feat in x_data.columns if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) != str]
+    cont_feats = numerical_features(x_data)
     x_data_cont = x_data[cont_feats]
     
     # get all possible combinations of 2 features
@@ -187,7 +373,7 @@ def visualize_categorical_data(x_data, y_data, normalize=True):
     For each categorical feature, plot a bar chart for each class.
     '''
     # get only the categorical features
-    disc_feats = [feat for feat in x_data.columns if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) == str]
+    disc_feats = categorical_features(x_data)
     x_data_disc = x_data[disc_feats]
     
     # get unique values of y_data and use it to partition the dataset
@@ -292,22 +478,11 @@ def read_sample(path):
     module_dir = os.path.dirname(__file__)
     path = os.path.join(module_dir, path)
 
-    x_data = pd.read_csv(path)
-
-    # extract only the numerical features
-    cont_feats = [feat for feat in x_data.columns if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) != str]
-    x_data = x_data[cont_feats]
-    for feat in x_data.columns:
-        x_data[feat] = x_data[feat].astype(float)
+    # read only the numerical features
+    x_data = read_csv(path, NUMERICAL)
 
-    # standardize the numerical features
-    for feat in x_data.columns:
-        x_data[feat] = (x_data[feat] - x_data[feat].mean())/x_data[feat].std()
+    # standardize the numerical features with the statistics saved by read_data (never those of the sample)
+    preprocessor = Preprocessor.load(preprocessor_path(kind="Numerical"))
+    x_data = preprocessor.transform(x_data)
 
     return x_data
-
-
-
-
-    
-
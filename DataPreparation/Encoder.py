@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from DataPreparation.Schema import categorical_features
+
+
+class Encoder:
+    '''
+    Encodes all the categorical features of a frame at once with one of the read_data encodings:
+    - Label: each value is replaced by its index in the codebook
+    - OneHot: each feature is replaced by one 0/1 column per value in the codebook (appended after the other features)
+    - Frequency: each value is replaced by its relative frequency in the data the encoder was fitted on
+    Values that are not in the codebook (unseen data) fall in an unknown bucket: the code len(codebook) for Label,
+    no active column for OneHot and a frequency of 0 for Frequency.
+    '''
+    def __init__(self, method='OneHot', codebooks=None, frequencies=None):
+        self.method = method
+        self.codebooks = {feat: list(values) for feat, values in (codebooks or {}).items()}
+        self.frequencies = {feat: list(values) for feat, values in (frequencies or {}).items()}
+
+    def codes(self, x_data, feat):
+        '''
+        returns the index of each value of the feature in its codebook (-1 for unknown or missing values).
+        '''
+        column = x_data[feat]
+        if isinstance(column.dtype, pd.CategoricalDtype) and column.cat.categories.tolist() == self.codebooks[feat]:
+            return column.cat.codes.to_numpy()
+        return pd.Categorical(column, categories=self.codebooks[feat]).codes
+
+    def fit(self, x_data):
+        '''
+        Learn the codebook of every categorical feature that is not given already (and their frequencies) in one pass.
+        '''
+        for feat in categorical_features(x_data):
+            if feat not in self.codebooks:
+                column = x_data[feat]
+                if isinstance(column.dtype, pd.CategoricalDtype):  self.codebooks[feat] = column.cat.categories.tolist()
+                else:                                               self.codebooks[feat] = sorted(column.dropna().unique())
+            codes = self.codes(x_data, feat)
+            counts = np.bincount(codes[codes >= 0], minlength=len(self.codebooks[feat]))
+            self.frequencies[feat] = (counts / len(x_data)).tolist()
+        return self
+
+    def get_feature_names_out(self, columns):
+        '''
+        returns the names of the columns produced by transform for a frame with the given columns.
+        '''
+        if self.method != 'OneHot':
+            return list(columns)
+        names = [feat for feat in columns if feat not in self.codebooks]
+        for feat in columns:
+            if feat in self.codebooks:
+                names += [f'{feat}_{value}' for value in self.codebooks[feat]]
+        return names
+
+    def transform(self, x_data, sparse=False):
+        '''
+        Encode x_data into a float32 matrix whose columns are named by get_feature_names_out.
+        If sparse is true, a scipy.sparse CSR matrix is returned instead of a dense array.
+        '''
+        n = len(x_data)
+        disc_feats = [feat for feat in x_data.columns if feat in self.codebooks]
+        if self.method != 'OneHot':
+            x = np.empty((n, len(x_data.columns)), dtype=np.float32)
+            for j, feat in enumerate(x_data.columns):
+                if feat not in self.codebooks:
+                    x[:, j] = x_data[feat].to_numpy(dtype=np.float32)
+                    continue
+                codes = self.codes(x_data, feat)
+                if self.method == 'Label':
+                    x[:, j] = np.where(codes >= 0, codes, len(self.codebooks[feat]))
+                else:
+                    # the last entry is the frequency of the unknown bucket
+                    x[:, j] = np.append(self.frequencies[feat], 0)[codes]
+            return sp.csr_matrix(x) if sparse else x
+
+        # OneHot: the other features first, then the one-hot columns of each categorical feature
+        cont_feats = [feat for feat in x_data.columns if feat not in self.codebooks]
+        x_cont = x_data[cont_feats].to_numpy(dtype=np.float32)
+        rows, cols, offset = [], [], len(cont_feats)
+        for feat in disc_feats:
+            codes = self.codes(x_data, feat)
+            known = codes >= 0
+            rows.append(np.flatnonzero(known))
+            cols.append(offset + codes[known])
+            offset += len(self.codebooks[feat])
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=int)
+        if sparse:
+            one_hot = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols - len(cont_feats))), shape=(n, offset - len(cont_feats)))
+            return sp.hstack([sp.csr_matrix(x_cont), one_hot], format='csr')
+        x = np.zeros((n, offset), dtype=np.float32)
+        x[:, :len(cont_feats)] = x_cont
+        x[rows, cols] = 1
+        return x
+
+    def transform_frame(self, x_data):
+        '''
+        Like transform but returns a DataFrame with the same index as x_data.
+        '''
+        return pd.DataFrame(self.transform(x_data), index=x_data.index, columns=self.get_feature_names_out(x_data.columns))
+
+    def fit_transform(self, x_data, sparse=False):
+        return self.fit(x_data).transform(x_data, sparse)
+
+    def to_dict(self):
+        return {'method': self.method, 'codebooks': self.codebooks, 'frequencies': self.frequencies}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['method'], d['codebooks'], d['frequencies'])
@@ -0,0 +1,118 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from DataPreparation.Encoder import Encoder
+
+
+class Preprocessor:
+    '''
+    A fitted preprocessing artifact holding the column order, dtypes, category codebooks, the fitted encoder (if any)
+    and the means and stds used for standardization. It is fitted once on the training data, saved to a directory and memory-mapped back
+    on load so that scoring never recomputes statistics from the batch being scored.
+    '''
+    def __init__(self, columns=None, dtypes=None, codebooks=None, numerical=None, means=None, stds=None, encoder=None):
+        self.columns = list(columns) if columns is not None else []
+        self.dtypes = dict(dtypes) if dtypes is not None else {}
+        self.codebooks = {feat: list(values) for feat, values in (codebooks or {}).items()}
+        self.numerical = list(numerical) if numerical is not None else []
+        self.means = np.asarray(means, dtype=np.float64) if means is not None else np.zeros(0)
+        self.stds = np.asarray(stds, dtype=np.float64) if stds is not None else np.zeros(0)
+        self.encoder = encoder
+        self._compile()
+
+    def _compile(self):
+        '''
+        Precompute the position of each numerical column so transform is a single matrix operation.
+        Constant columns (std of 0) are only centered.
+        '''
+        self._positions = {feat: i for i, feat in enumerate(self.numerical)}
+        self._stds = np.where(self.stds == 0, 1, self.stds)
+
+    def fit(self, x_data, codebooks=None):
+        '''
+        Learn the column order, dtypes and the mean and std of every non-string column of x_data.
+        codebooks maps each categorical feature to its possible values (they may no longer be in x_data if it was encoded).
+        '''
+        self.columns = list(x_data.columns)
+        self.dtypes = {feat: str(dtype) for feat, dtype in x_data.dtypes.items()}
+        self.codebooks = {feat: list(values) for feat, values in (codebooks or {}).items()}
+        self.numerical = [feat for feat in x_data.columns if pd.api.types.is_numeric_dtype(x_data[feat])]
+        x = x_data[self.numerical].to_numpy(dtype=np.float64)
+        self.means = x.mean(axis=0)
+        self.stds = x.std(axis=0, ddof=1)
+        self._compile()
+        return self
+
+    def transform(self, x_data):
+        '''
+        Standardize the numerical columns of x_data using the fitted means and stds.
+        x_data may hold any subset of the fitted columns; other columns are returned untouched.
+        '''
+        feats = [feat for feat in x_data.columns if feat in self._positions]
+        idx = [self._positions[feat] for feat in feats]
+        x_data = x_data.copy()
+        if not feats: return x_data
+        x_data[feats] = (x_data[feats].to_numpy(dtype=np.float64) - self.means[idx]) / self._stds[idx]
+        return x_data
+
+    def fit_transform(self, x_data, codebooks=None):
+        return self.fit(x_data, codebooks).transform(x_data)
+
+    def save(self, path):
+        '''
+        Save the preprocessor into the directory path (a small json plus one .npy file per array).
+        '''
+        os.makedirs(path, exist_ok=True)
+        meta = {'columns': self.columns, 'dtypes': self.dtypes, 'codebooks': self.codebooks, 'numerical': self.numerical,
+                'encoder': self.encoder.to_dict() if self.encoder is not None else None}
+        with open(os.path.join(path, 'preprocessor.json'), 'w') as f:
+            json.dump(meta, f, indent=4)
+        np.save(os.path.join(path, 'means.npy'), self.means)
+        np.save(os.path.join(path, 'stds.npy'), self.stds)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Load a saved preprocessor; the statistics are memory-mapped rather than read into memory.
+        '''
+        with open(os.path.join(path, 'preprocessor.json'), 'r') as f:
+            meta = json.load(f)
+        encoder = Encoder.from_dict(meta['encoder']) if meta.get('encoder') else None
+        means = np.load(os.path.join(path, 'means.npy'), mmap_mode=mmap_mode)
+        stds = np.load(os.path.join(path, 'stds.npy'), mmap_mode=mmap_mode)
+        return cls(meta['columns'], meta['dtypes'], meta['codebooks'], meta['numerical'], means, stds, encoder)
+
+
+class RunningMoments:
+    '''
+    Running count, mean and sum of squared deviations (M2) of the columns of a stream of chunks.
+    Chunks are merged with Welford's update (in its pairwise form) so the whole stream never has to be in memory.
+    '''
+    def __init__(self, n_cols):
+        self.count = 0
+        self.mean = np.zeros(n_cols)
+        self.m2 = np.zeros(n_cols)
+
+    def update(self, x):
+        '''
+        Merge the rows of the 2D array x into the running moments.
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        if len(x) == 0: return self
+        self.merge(len(x), x.mean(axis=0), ((x - x.mean(axis=0))**2).sum(axis=0))
+        return self
+
+    def merge(self, count, mean, m2):
+        '''
+        Merge the moments of another part of the stream (e.g. computed by another worker).
+        '''
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * count / total
+        self.count = total
+        return self
+
+    def std(self, ddof=1):
+        return np.sqrt(self.m2 / (self.count - ddof))
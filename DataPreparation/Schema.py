@@ -0,0 +1,55 @@
+'''
+The declared schema of the dataset: which features are categorical or numerical and the values each categorical feature can take.
+It drives how csv files are parsed so that column types never depend on the content of the first row.
+'''
+import numpy as np
+import pandas as pd
+
+TARGET = 'Body_Level'
+
+# columns names for the dataset and thier types
+CATEGORICAL=['Gender', 'H_Cal_Consump', 'Alcohol_Consump', 'Smoking','Food_Between_Meals', 'Fam_Hist', 'H_Cal_Burn', 'Transport']
+NUMERICAL=['Age', 'Height', 'Weight', 'Veg_Consump', 'Water_Consump', 'Meal_Count','Phys_Act', 'Time_E_Dev']
+MIXED=['Gender', 'Age', 'Height', 'Weight', 'H_Cal_Consump', 'Veg_Consump','Water_Consump', 'Alcohol_Consump', 'Smoking', 'Meal_Count','Food_Between_Meals', 'Fam_Hist', 'H_Cal_Burn', 'Phys_Act','Time_E_Dev', 'Transport']
+
+# possible values of each categorical feature
+CATEGORIES = {
+    'Gender': ['Female', 'Male'],
+    'H_Cal_Consump': ['no', 'yes'],
+    'Alcohol_Consump': ['Always', 'Frequently', 'Sometimes', 'no'],
+    'Smoking': ['no', 'yes'],
+    'Food_Between_Meals': ['Always', 'Frequently', 'Sometimes', 'no'],
+    'Fam_Hist': ['no', 'yes'],
+    'H_Cal_Burn': ['no', 'yes'],
+    'Transport': ['Automobile', 'Bike', 'Motorbike', 'Public_Transportation', 'Walking'],
+}
+
+
+def dtypes(features=MIXED):
+    '''
+    returns the dtype of each of the given features: a category dtype for categorical ones and float32 for numerical ones.
+    '''
+    return {feat: pd.CategoricalDtype(CATEGORIES[feat]) if feat in CATEGORICAL else np.float32 for feat in features}
+
+
+def read_csv(path, features=MIXED, **kwargs):
+    '''
+    reads only the given features (and the target if the file has it) from a csv file, typed according to the schema.
+    Values of a categorical feature that are not declared in CATEGORIES are read as missing.
+    '''
+    return pd.read_csv(path, usecols=lambda col: col in features or col == TARGET, dtype=dtypes(features), **kwargs)
+
+
+def categorical_features(x_data):
+    '''
+    returns the features of x_data that are declared categorical and have not been encoded into numbers yet.
+    '''
+    return [feat for feat in x_data.columns if feat in CATEGORICAL and not pd.api.types.is_numeric_dtype(x_data[feat])]
+
+
+def numerical_features(x_data):
+    '''
+    returns the features of x_data that hold numbers (numerical features and encoded categorical ones).
+    '''
+    categorical = categorical_features(x_data)
+    return [feat for feat in x_data.columns if feat not in categorical]
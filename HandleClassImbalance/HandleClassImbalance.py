@@ -1,22 +1,31 @@
 from imblearn.over_sampling import SMOTE,SMOTENC,SMOTEN,BorderlineSMOTE
 from imblearn.under_sampling import NearMiss,RandomUnderSampler
 import numpy as np
-from utils import nice_table
+import numbers
+import os
+import hashlib
+from scipy import sparse
+from sklearn.base import BaseEstimator
+from sklearn.neighbors import NearestNeighbors
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from joblib import Memory
+from tqdm import tqdm
+from sklearn.base import clone
+from sklearn.model_selection import StratifiedKFold
+from imblearn.base import BaseSampler
+from imblearn.pipeline import Pipeline
+from utils import nice_table, SAVED
 from IPython.display import display
 import pandas as pd
-from sklearn.model_selection import cross_val_predict
 from mlpath import mlquest as mlq
 import matplotlib.pyplot as plt
-from sklearn.metrics import f1_score
+from ModelPipelines.Metrics import metrics
+from DataPreparation.Schema import CATEGORICAL, NUMERICAL, MIXED
 
 
-# columns names for the dataset and thier types 
-CATEGORICAL=['Gender', 'H_Cal_Consump', 'Alcohol_Consump', 'Smoking','Food_Between_Meals', 'Fam_Hist', 'H_Cal_Burn', 'Transport']
-NUMERICAL=['Age', 'Height', 'Weight', 'Veg_Consump', 'Water_Consump', 'Meal_Count','Phys_Act', 'Time_E_Dev']
-MIXED=['Gender', 'Age', 'Height', 'Weight', 'H_Cal_Consump', 'Veg_Consump','Water_Consump', 'Alcohol_Consump', 'Smoking', 'Meal_Count','Food_Between_Meals', 'Fam_Hist', 'H_Cal_Burn', 'Phys_Act','Time_E_Dev', 'Transport']
 COLOR= '#ECAF93' # color for the plots
 
-def handle_class_imbalance(X,y, method=None,k=None, sampling_ratio=[1,1,1]):
+def handle_class_imbalance(X,y, method=None,k=None, sampling_ratio=[1,1,1], index=None):
     '''
     - this function handles the class imbalance problem in the dataset
     - takes the dataset as input X, y
@@ -25,11 +34,12 @@ def handle_class_imbalance(X,y, method=None,k=None, sampling_ratio=[1,1,1]):
     - k nearest neighbors used to define the neighborhood of samples in case of oversampling
     - sampling_ratio list contains ratios of samples in each class over majority class after resampling
       if  ratio is 1 then the number of samples in that class will be the same as majority class
+    - index is an optional NeighborIndex that lets oversamplers reuse nearest neighbor searches
     - returns balanced data set bal_X, bal_y or return weights of classes in case of cost sensitive 
     '''
     over_sampling_methods = ['SMOTE','SMOTENC','SMOTEN',"BorderlineSMOTE"]
     if method in over_sampling_methods:
-        bal_X, bal_y = over_sampling(X,y,k, sampling_ratio,method)
+        bal_X, bal_y = over_sampling(X,y,k, sampling_ratio,method, index)
         return bal_X,bal_y
     
     elif method == 'Under Sampling':
@@ -44,7 +54,7 @@ def handle_class_imbalance(X,y, method=None,k=None, sampling_ratio=[1,1,1]):
     
 #--------------------------------- Resampling Functions ----------------------------------------------
 
-def over_sampling( X,y,k,sampling_ratio,method ):
+def over_sampling( X,y,k,sampling_ratio,method, index=None ):
 
     #----- handling the sampling strategy for each class
     sampling_strategy= dict() 
@@ -58,6 +68,9 @@ def over_sampling( X,y,k,sampling_ratio,method ):
             print("after over sampling he number of samples in a class should be >= to the original number of samples")
             return X,y
     sampling_strategy[3]=Nmj #unchanged
+    #------- the k nearest neighbors are answered by the shared index if there is one
+    if index is not None:
+        k = SharedNeighbors(n_neighbors=k+1, index=index)
     #------------------------
     if method == "SMOTE":
         if X.columns.tolist() != NUMERICAL:
@@ -102,6 +115,108 @@ def cost_sensitive(y):
         weights[i]=1 /len(y[y == i])
     return weights
 
+#-------------------------------- Nearest Neighbors --------------------------------
+
+def fingerprint(X):
+    '''
+    a hash of the content of a dense or sparse array
+    '''
+    sha = hashlib.sha1(str((X.shape, X.dtype)).encode())
+    arrays = [X.data, X.indices, X.indptr] if sparse.issparse(X) else [np.asarray(X)]
+    for array in arrays:
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+class NeighborIndex:
+    '''
+    a cache of nearest neighbor searches shared by all the oversamplers of a sweep
+    - each search is run once for max_neighbors and sliced for any smaller k
+    - searches are keyed by the content of the searched and queried points, so resampling the same data again
+      with another k (or another oversampler searching the same points) costs no new search
+    - dense data under the euclidean distance is searched with a KD-tree; SMOTEN and SMOTENC keep the
+      distances imblearn defines for them (value difference metric, scaled one-hot encoding)
+    '''
+    def __init__(self, max_neighbors=51):
+        self.max_neighbors = max_neighbors
+        self.searches = {}
+
+    def __deepcopy__(self, memo):
+        # imblearn clones the neighbors estimator holding the index; the clone must keep sharing it
+        return self
+
+    def kneighbors(self, X, Q, n_neighbors, metric="minkowski"):
+        key = (fingerprint(X), fingerprint(Q), metric)
+        dist, ind = self.searches.get(key, (None, None))
+        if ind is None or ind.shape[1] < n_neighbors:
+            n = max(n_neighbors, min(self.max_neighbors, X.shape[0]))
+            algorithm = 'kd_tree' if metric in ["minkowski", "euclidean"] and not sparse.issparse(X) else 'auto'
+            dist, ind = NearestNeighbors(n_neighbors=n, metric=metric, algorithm=algorithm).fit(X).kneighbors(Q)
+            self.searches[key] = (dist, ind)
+        return dist[:, :n_neighbors], ind[:, :n_neighbors]
+
+class SharedNeighbors(BaseEstimator):
+    '''
+    a NearestNeighbors look-alike that is given to the oversamplers and answers from a shared NeighborIndex
+    '''
+    def __init__(self, n_neighbors=6, index=None, metric="minkowski"):
+        self.n_neighbors = n_neighbors
+        self.index = index
+        self.metric = metric
+
+    def fit(self, X, y=None):
+        self.index_ = self.index if self.index is not None else NeighborIndex(self.n_neighbors)
+        self.fit_X_ = X
+        self.n_samples_fit_ = X.shape[0]
+        return self
+
+    def kneighbors(self, X=None, n_neighbors=None, return_distance=True):
+        n_neighbors = n_neighbors or self.n_neighbors
+        if X is None:
+            # like NearestNeighbors, a query without points excludes each point from its own neighbors
+            dist, ind = self.index_.kneighbors(self.fit_X_, self.fit_X_, n_neighbors + 1, self.metric)
+            dist, ind = dist[:, 1:], ind[:, 1:]
+        else:
+            dist, ind = self.index_.kneighbors(self.fit_X_, X, n_neighbors, self.metric)
+        return (dist, ind) if return_distance else ind
+
+    def kneighbors_graph(self, X=None, n_neighbors=None, mode="connectivity"):
+        dist, ind = self.kneighbors(X, n_neighbors)
+        data = np.ones(ind.size) if mode == "connectivity" else dist.ravel()
+        indptr = np.arange(0, ind.size + 1, ind.shape[1])
+        return sparse.csr_matrix((data, ind.ravel(), indptr), shape=(ind.shape[0], self.n_samples_fit_))
+
+#-------------------------------- Pipeline Stage --------------------------------
+
+# resampled datasets are cached on disk keyed by the content of X, y and the configuration
+memory = Memory(os.path.join(SAVED, 'Cache', 'Resampling'), verbose=0)
+cached_handle_class_imbalance = memory.cache(handle_class_imbalance, ignore=['index'])
+
+class ClassImbalanceSampler(BaseSampler):
+    '''
+    handle_class_imbalance as a sampler that can be a step of an imblearn Pipeline, so that only the
+    training part of each cross validation fold is resampled (the test part is never synthetic)
+    - "Cost Sensitive" leaves the data as is (the weights are set on the classifier instead)
+    - if cache is true, the resampled data is reused from the disk cache when the same fold is resampled again
+    - index is an optional NeighborIndex shared by the oversamplers (e.g. while sweeping over k)
+    '''
+    _sampling_type = "bypass"
+
+    def __init__(self, method=None, k=5, sampling_ratio=(1,1,1), cache=True, index=None):
+        self.method = method
+        self.k = k
+        self.sampling_ratio = sampling_ratio
+        self.cache = cache
+        self.index = index
+
+    def fit_resample(self, X, y):
+        return self._fit_resample(X, y)
+
+    def _fit_resample(self, X, y):
+        if self.method == "Cost Sensitive":
+            return X, y
+        resample = cached_handle_class_imbalance if self.cache else handle_class_imbalance
+        return resample(X, y, method=self.method, k=self.k, sampling_ratio=list(self.sampling_ratio), index=self.index)
+
 #-------------------------------- Visualization Functions --------------------------------
 
 def show_difference(y,y_bal):
@@ -153,94 +268,95 @@ def show_results(accuracies, methods=[], k=[] , sample_ratio=[], title=""):
     display(df)
 
 #------------------------------------- Evaluation Functions ----------------------------------------
-def evaluate_class_imbalance_handler_over_methods(X,y ,clf , methods=[] , sample_ratio=[1,1,1], k=5):
+
+def normalize_config(method, k, sample_ratio):
+    '''
+    keeps only the parameters that matter for the method so that equivalent configurations are evaluated once
+    '''
+    if method in ['SMOTE','SMOTENC','SMOTEN',"BorderlineSMOTE"]:
+        return (method, k, tuple(sample_ratio))
+    return (method, None, None)
+
+def evaluate_fold(X, y, clf, method, Ks, sample_ratio, train, test, cache=True):
+    '''
+    fits clf on the training part of one fold resampled with each k in Ks and predicts the untouched test part
+    - all values of k are handled by the same task so they share one nearest neighbor search per class of the fold
+    - returns a dictionary mapping each k to the predictions for the test part
+    '''
+    x_train, y_train, x_test = X.iloc[train], y[train], X.iloc[test]
+    clf = clone(clf)
+    if method == "Cost Sensitive":
+        try:
+            clf.set_params(class_weight=cost_sensitive(y_train))
+        except ValueError:
+            print("this classifier has no parameter called class_weight")
+    index = NeighborIndex(int(max(Ks))+1) if all(isinstance(k, numbers.Integral) for k in Ks) else None
+    sampler = ClassImbalanceSampler(method, sampling_ratio=sample_ratio or (1,1,1), cache=cache, index=index)
+    pipe = Pipeline([('sampler', sampler), ('clf', clf)])
+    return {k: pipe.set_params(sampler__k=k).fit(x_train, y_train).predict(x_test) for k in Ks}
+
+def sweep(X, y, clf, configs, n_jobs=None, cache=True, cv=4):
+    '''
+    evaluates a grid of (method, k, sampling ratio) configurations with cv-fold cross validation where only the
+    training folds are resampled, spreading the (configuration, fold) tasks across a pool of processes
+    - equivalent configurations are only evaluated once (e.g. k does not matter for "Under Sampling")
+    - the folds are generated once and shared by all configurations; all k of a (method, ratio) run in the same fold task
+    - each resampled fold is cached on disk so sweeping again over the same data is fast
+    - returns a dictionary mapping each normalized configuration to its (accuracy, weighted f1-score)
+    '''
+    unique_configs = list(dict.fromkeys(normalize_config(*config) for config in configs))
+    groups = {}
+    for method, k, sample_ratio in unique_configs:
+        groups.setdefault((method, sample_ratio), []).append(k)
+    folds = list(StratifiedKFold(cv).split(X, y))
+    
+    y_preds = {config: np.zeros(len(y), dtype=np.asarray(y).dtype) for config in unique_configs}
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {pool.submit(evaluate_fold, X, y, clf, method, Ks, sample_ratio, train, test, cache): (method, sample_ratio, test)
+                   for (method, sample_ratio), Ks in groups.items() for train, test in folds}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            method, sample_ratio, test = futures[future]
+            for k, y_pred in future.result().items():
+                y_preds[(method, k, sample_ratio)][test] = y_pred
+    
+    # the metrics of all the configurations at once from their stacked predictions
+    accuracies, wf1s = metrics(y, np.stack(list(y_preds.values())))
+    return {config: (accuracy, wf1) for config, accuracy, wf1 in zip(y_preds, accuracies, wf1s)}
+
+def evaluate_class_imbalance_handler_over_methods(X,y ,clf , methods=[] , sample_ratio=[1,1,1], k=5, n_jobs=None):
     '''
     this function is used to evaluate the performance of the class imbalance handler over different methods
     and const value for k and sampling ratio
     '''
-    accuracies = []
-    weighted_f1_scores = []
-    for method in methods:
-        if method != "Cost Sensitive":
-            bal_x, bal_y = handle_class_imbalance(X, y, method=method,k=k, sampling_ratio=sample_ratio)
-            clf.fit(bal_x, bal_y)
-            y_pred = cross_val_predict(clf, bal_x, bal_y, cv=4)
-            accuracies.append( np.mean(y_pred == bal_y))
-            weighted_f1_scores.append(f1_score(bal_y, y_pred, average='weighted'))
-        else:
-            new_weights = handle_class_imbalance(X, y, method=method,k=k, sampling_ratio=sample_ratio)
-            try:
-                clf.set_params(class_weight=new_weights)
-            except:
-                print("this classifier has no parameter called class_weight")
-            
-            clf.fit(X, y)
-            y_pred = cross_val_predict(clf, X, y, cv=4)
-            accuracies.append( np.mean(y_pred == y))
-            weighted_f1_scores.append(f1_score(y, y_pred, average='weighted'))
+    configs = [(method, k, sample_ratio) for method in methods]
+    results = sweep(X, y, clf, configs, n_jobs)
+    weighted_f1_scores = [results[normalize_config(*config)][1] for config in configs]
     
     plot_results(weighted_f1_scores, methods, title="K = "+str(k)+", Sampling Ratio = "+str(sample_ratio))
 
 #---------------------------------------------------------------------------------
 
-def evaluate_const_k_diff_sample_ratios(X,y ,clf , method , k=5, sample_ratios=[]):
+def evaluate_const_k_diff_sample_ratios(X,y ,clf , method , k=5, sample_ratios=[], n_jobs=None):
     '''
     this function is used to evaluate the performance of the class imbalance handler for one
       method, const value for k and multiple values of sampling ratio
     '''
-    accuracies = []
-    weighted_f1_scores = []
-    for r in sample_ratios:
-        if method != "Cost Sensitive":
-            bal_x, bal_y = handle_class_imbalance(X, y, method=method,k=k, sampling_ratio=r)
-            clf.fit(bal_x, bal_y)
-            y_pred = cross_val_predict(clf, bal_x, bal_y, cv=4)
-            accuracies.append( np.mean(y_pred == bal_y))
-            weighted_f1_scores.append(f1_score(bal_y, y_pred, average='weighted'))  
-        else:
-            new_weights = handle_class_imbalance(X, y, method=method,k=k, sampling_ratio=r)
-            try:
-                clf.set_params(class_weight=new_weights)
-            except:
-                print("this classifier has no parameter called class_weight")
-            
-            clf.fit(X, y)
-            y_pred = cross_val_predict(clf, X, y, cv=4)
-            accuracies.append( np.mean(y_pred == y))
-            weighted_f1_scores.append(f1_score(y, y_pred, average='weighted'))   
-
-    return weighted_f1_scores
+    configs = [(method, k, r) for r in sample_ratios]
+    results = sweep(X, y, clf, configs, n_jobs)
+    return [results[normalize_config(*config)][1] for config in configs]
 
 #------------------------------------------------------------------------------------
 
-def evaluate_const_sample_ratios_diff_k(X,y ,clf , method , Ks, sample_ratio=[1,1,1]):
+def evaluate_const_sample_ratios_diff_k(X,y ,clf , method , Ks, sample_ratio=[1,1,1], n_jobs=None):
     '''
     this function is used to evaluate the performance of the class imbalance handler for one
       method, const value for sampling ratio and multiple values of k
     '''
-    accuracies = []
-    weighted_f1_scores = []
-    for k in Ks:
-        if method != "Cost Sensitive":
-            bal_x, bal_y = handle_class_imbalance(X, y, method=method,k=k, sampling_ratio=sample_ratio)
-            clf.fit(bal_x, bal_y)
-            y_pred = cross_val_predict(clf, bal_x, bal_y, cv=4)
-            accuracies.append( np.mean(y_pred == bal_y))
-            weighted_f1_scores.append(f1_score(bal_y, y_pred, average='weighted'))
-        else:
-            new_weights = handle_class_imbalance(X, y, method=method,k=k, sampling_ratio=sample_ratio)
-            try:
-                clf.set_params(class_weight=new_weights)
-            except:
-                print("this classifier has no parameter called class_weight")
-            
-            clf.fit(X, y)
-            y_pred = cross_val_predict(clf, X, y, cv=4)
-            accuracies.append( np.mean(y_pred == y))  
-            weighted_f1_scores.append(f1_score(y, y_pred, average='weighted'))
-    return weighted_f1_scores
-
-def plot_different_evaluations( X,y, clf, methods, sample_ratios , const_sample_ratio,const_k, Ks):
+    configs = [(method, k, sample_ratio) for k in Ks]
+    results = sweep(X, y, clf, configs, n_jobs)
+    return [results[normalize_config(*config)][1] for config in configs]
+
+def plot_different_evaluations( X,y, clf, methods, sample_ratios , const_sample_ratio,const_k, Ks, n_jobs=None):
     '''
     This function is used to plot the results of the evaluation of the class imbalance handler
     over different methods, const value for k and different sampling ratios and const value for
@@ -251,13 +367,18 @@ def plot_different_evaluations( X,y, clf, methods, sample_ratios , const_sample_
     titles = []
     x_labels = []
 
+    # evaluate the whole grid at once so that it is de-duplicated and spread over all processes
+    configs = [(method, k, const_sample_ratio) for method in methods for k in Ks]
+    configs += [(method, const_k, r) for method in methods for r in sample_ratios]
+    results = sweep(X, y, clf, configs, n_jobs)
+
     for method in methods:
-        scores1 =evaluate_const_sample_ratios_diff_k(X,y ,clf , method , Ks, const_sample_ratio)
+        scores1 = [results[normalize_config(method, k, const_sample_ratio)][1] for k in Ks]
         Scores.append( scores1)
         Labels.append( Ks)
         titles.append("Method: "+method+", Sampling Ratio = "+str(const_sample_ratio))
         x_labels.append("K")
-        scores2 =evaluate_const_k_diff_sample_ratios(X,y ,clf , method , const_k, sample_ratios)
+        scores2 = [results[normalize_config(method, const_k, r)][1] for r in sample_ratios]
         Scores.append( scores2)
         Labels.append( sample_ratios)
         titles.append("Method: "+method+", K = "+str(const_k))
@@ -0,0 +1,103 @@
+'''
+Numeric classification metrics computed from confusion matrices, without going through the text of classification_report.
+All of them work on a single vector of predictions or on many at once (a stack of shape (m, n), e.g. the predictions of
+every configuration of a sweep), in which case they return one value per vector.
+'''
+import numpy as np
+
+
+def encode_labels(y_true, y_pred, labels=None):
+    '''
+    returns the labels and the predictions as integer codes 0..C-1 along with the labels.
+    The code of a value is its position in labels (in any order). If labels is not given it is the sorted union of the
+    labels that occur in y_true and y_pred. Raises ValueError if y_true or y_pred holds a value that is not in labels.
+    '''
+    y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+    if labels is None:
+        labels = np.union1d(np.unique(y_true), np.unique(y_pred))
+    labels = np.asarray(labels)
+    if np.issubdtype(labels.dtype, np.integer) and np.array_equal(labels, np.arange(len(labels))):
+        # the labels are their own codes
+        for y in (y_true, y_pred):
+            if y.size and (y.min() < 0 or y.max() >= len(labels) or not np.array_equal(y, y.astype(np.int64))):
+                raise ValueError(f'{np.setdiff1d(np.unique(y), labels).tolist()} are not in labels')
+        return y_true.astype(np.int64), y_pred.astype(np.int64), labels
+    order = np.argsort(labels, kind='stable')
+    ordered = labels[order]
+    def encode(y):
+        position = np.minimum(np.searchsorted(ordered, y), len(labels) - 1)
+        if not np.all(ordered[position] == y):
+            raise ValueError(f'{np.setdiff1d(np.unique(y), labels).tolist()} are not in labels')
+        return order[position]
+    return encode(y_true), encode(y_pred), labels
+
+
+def confusion_matrices(y_true, y_pred, labels=None):
+    '''
+    Confusion matrices (rows are true classes, columns predicted ones) of one or a stack of prediction vectors.
+    y_true is a vector shared by all the predictions or a stack of the same shape as y_pred.
+    All the matrices are counted with a single bincount; returns shape (C, C) or (m, C, C).
+    '''
+    y_true, y_pred, labels = encode_labels(y_true, y_pred, labels)
+    n_classes = len(labels)
+    stacked = y_pred.ndim > 1
+    y_pred = np.atleast_2d(y_pred)
+    y_true = np.broadcast_to(y_true, y_pred.shape)
+    offsets = np.arange(len(y_pred))[:, None] * n_classes**2
+    counts = np.bincount((offsets + y_true * n_classes + y_pred).ravel(), minlength=len(y_pred) * n_classes**2)
+    counts = counts.reshape(len(y_pred), n_classes, n_classes)
+    return counts if stacked else counts[0]
+
+
+def accuracy(confusion):
+    hits = np.trace(confusion, axis1=-2, axis2=-1)
+    return hits / confusion.sum(axis=(-2, -1))
+
+
+def precision(confusion):
+    '''
+    precision of each class (0 for a class that is never predicted, like sklearn).
+    '''
+    hits, predicted = np.diagonal(confusion, axis1=-2, axis2=-1), confusion.sum(axis=-2)
+    return np.divide(hits, predicted, out=np.zeros(hits.shape), where=predicted > 0)
+
+
+def recall(confusion):
+    '''
+    recall of each class (0 for a class that never occurs).
+    '''
+    hits, support = np.diagonal(confusion, axis1=-2, axis2=-1), confusion.sum(axis=-1)
+    return np.divide(hits, support, out=np.zeros(hits.shape), where=support > 0)
+
+
+def f1(confusion):
+    '''
+    F1 of each class: 2PR/(P+R) = 2TP/(support+predicted), 0 for a class that is never true nor predicted.
+    '''
+    hits = np.diagonal(confusion, axis1=-2, axis2=-1)
+    total = confusion.sum(axis=-1) + confusion.sum(axis=-2)
+    return np.divide(2 * hits, total, out=np.zeros(hits.shape), where=total > 0)
+
+
+def weighted_f1(confusion):
+    '''
+    F1 of each class averaged with the support of the class as weight.
+    '''
+    support = confusion.sum(axis=-1)
+    return (f1(confusion) * support).sum(axis=-1) / support.sum(axis=-1)
+
+
+def metrics(y_true, y_pred, labels=None):
+    '''
+    accuracy and weighted F1 of one or a stack of prediction vectors.
+    '''
+    confusion = confusion_matrices(y_true, y_pred, labels)
+    return accuracy(confusion), weighted_f1(confusion)
+
+
+def running_mean(x):
+    '''
+    the means of x[:1], x[:2], ..., x[:n] from one cumulative sum.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    return np.cumsum(x) / np.arange(1, len(x) + 1)
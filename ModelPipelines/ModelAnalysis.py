@@ -1,27 +1,110 @@
 from sklearn.model_selection import RandomizedSearchCV, StratifiedKFold, validation_curve, learning_curve
 from sklearn.metrics import classification_report
-from sklearn.model_selection import cross_val_predict, LeaveOneOut, RepeatedKFold
-from sklearn.feature_selection import RFECV
+from sklearn.base import clone
+from sklearn.naive_bayes import GaussianNB
+from sklearn.linear_model import LogisticRegression, RidgeClassifier, SGDClassifier, Perceptron, PassiveAggressiveClassifier
+from sklearn.neural_network import MLPClassifier
+from sklearn.utils.class_weight import compute_sample_weight
+from joblib import Parallel, delayed, Memory
+import joblib
+from sklearn.model_selection import cross_val_predict, LeaveOneOut, RepeatedKFold, ParameterSampler
+from sklearn.inspection import permutation_importance
 import matplotlib.pyplot as plt
 import numpy as np
 import sys
+import time
+import copy
+import math
+import hashlib
+import os
 sys.path.append("../../")
-from utils import nice_table, save_hyperparameters
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import nice_table, save_hyperparameters, load_search, save_search, SAVED
 from IPython.display import display, HTML, Markdown
 from IPython.display import clear_output, HTML
 import warnings
-from utils import nice_table, get_metrics
+from utils import nice_table
+from ModelPipelines.Metrics import metrics, running_mean
 
-def recursive_feature_elimination(clf, min_feats, cv, x_data_d, y_data_d, disp=True):
+def elimination_schedule(n_features, min_feats, step=0.1):
+    '''
+    The numbers of features of the rounds of recursive feature elimination, from n_features down to min_feats.
+    A step >= 1 (int or float, as in sklearn's RFE) removes int(step) features per round, a step between 0 and 1 removes that
+    fraction of the remaining ones (at least one) and a step <= 0 raises ValueError. With a fraction, hundreds of one-hot
+    columns are eliminated in a few dozen rounds while the last rounds still remove one at a time.
+    '''
+    if step <= 0:
+        raise ValueError(f'step must be positive, got {step}')
+    sizes = [n_features]
+    while sizes[-1] > min_feats:
+        remove = int(step) if step >= 1 else max(1, int(math.ceil(step * sizes[-1])))
+        sizes.append(max(sizes[-1] - remove, min_feats))
+    return sizes
+
+
+def feature_weights(clf, x_data, y_data, importance='auto', random_state=None):
+    '''
+    Importance of each feature for a fitted model: the squared weights summed over the classes (coef_, as RFE ranks them), the
+    feature_importances_ of tree ensembles, or the permutation importance (importance='permutation', also used when the model
+    has neither).
+    '''
+    if importance == 'auto' and hasattr(clf, 'coef_'):
+        return (clf.coef_**2).sum(axis=0) if clf.coef_.ndim > 1 else clf.coef_**2
+    if importance == 'auto' and hasattr(clf, 'feature_importances_'):
+        return clf.feature_importances_
+    return permutation_importance(clf, x_data, y_data, scoring='f1_weighted', n_repeats=5, random_state=random_state).importances_mean
+
+
+def eliminate(clf, x_data, y_data, sizes, importance='auto', test=None, random_state=None):
+    '''
+    Recursive feature elimination on numpy data following the given schedule.
+    Linear models with warm_start are refitted from the weights of the previous round restricted to the kept features.
+    Returns the fitted model, the features kept at the last round and the wf1 on the test data (x_test, y_test) of each round.
+    '''
+    features = np.arange(x_data.shape[1])
+    model, scores = clone(clf), []
+    labels = np.unique(y_data)
+    for i, size in enumerate(sizes):
+        model.fit(x_data[:, features], y_data)
+        if test is not None:
+            y_pred = model.predict(test[0][:, features])
+            scores.append(metrics(test[1], y_pred, labels)[1])
+        if i + 1 == len(sizes): break
+        weights = feature_weights(model, x_data[:, features], y_data, importance, random_state)
+        # drop the weakest features
+        keep = np.sort(np.argsort(weights)[len(features) - sizes[i+1]:])
+        features = features[keep]
+        if hasattr(model, 'coef_') and 'warm_start' in model.get_params() and model.coef_.ndim > 1:
+            model.coef_ = model.coef_[:, keep]
+            model.set_params(warm_start=True)
+        else:
+            model = clone(clf)
+    return model, features, scores
+
+
+def recursive_feature_elimination(clf, min_feats, cv, x_data_d, y_data_d, disp=True, step=0.1, importance='auto', n_jobs=-1, random_state=None):
     '''
     Recursive feature elimination recursively removes the weakest feature as determined by the given classifier.
     It stops when the desired number of features is reached or wf1 is no longer improving.
+    Features are removed following elimination_schedule(step), the folds are eliminated in parallel and the number of features
+    with the best mean wf1 (the fewest among ties) is then selected on all the data.
+    Feature weights come from coef_ or feature_importances_, or from permutation importance (importance='permutation').
     '''
-    rfecv = RFECV(estimator=clf, cv=StratifiedKFold(cv), scoring="f1_weighted", min_features_to_select=min_feats)
-    rfecv.fit(x_data_d, y_data_d)
-    opt_feats = rfecv.get_feature_names_out(x_data_d.columns)
-    # average the weights for the four classes (coef[0], coef[1], coef[2], coef[3])
-    weights = np.mean(np.abs(rfecv.estimator_.coef_), axis=0)
+    x, y = np.asarray(x_data_d, dtype=np.float64), np.asarray(y_data_d)
+    sizes = elimination_schedule(x.shape[1], min_feats, step)
+    folds = StratifiedKFold(cv).split(x, y)
+    fold_scores = Parallel(n_jobs=n_jobs)(delayed(eliminate)(clf, x[train_index], y[train_index], sizes, importance,
+                                                             (x[test_index], y[test_index]), random_state)
+                                          for train_index, test_index in folds)
+    mean_scores = np.mean([scores for _, _, scores in fold_scores], axis=0)
+    best = np.flatnonzero(mean_scores == mean_scores.max())[-1]
+    estimator, features, _ = eliminate(clf, x, y, sizes[:best+1], importance, random_state=random_state)
+    opt_feats = x_data_d.columns[features]
+    if importance == 'auto' and hasattr(estimator, 'coef_'):
+        # average the weights for the four classes (coef[0], coef[1], coef[2], coef[3])
+        weights = np.mean(np.abs(estimator.coef_), axis=0)
+    else:
+        weights = feature_weights(estimator, x[:, features], y, importance, random_state)
     
     opt_feats =  dict(sorted(zip( opt_feats, weights), key=lambda item: item[1]))
     display(HTML(nice_table(opt_feats, 'Features to Keep & Ranking')))
@@ -31,10 +114,9 @@ def recursive_feature_elimination(clf, min_feats, cv, x_data_d, y_data_d, disp=T
         plt.figure(figsize=(10, 6))
         plt.xlabel("Number of features selected")
         plt.ylabel("Mean test wf1")
-        plt.errorbar(range(min_feats, len(rfecv.cv_results_["mean_test_score"])+min_feats), 
-                    rfecv.cv_results_["mean_test_score"])
+        plt.errorbar(sizes, mean_scores)
         # draw a dashed red line through the selected number of features
-        plt.axvline(x=rfecv.n_features_, color='r', linestyle='--')
+        plt.axvline(x=sizes[best], color='r', linestyle='--')
         
         plt.title("Recursive Feature Elimination")
    
@@ -166,10 +248,84 @@ def show_hyperparams(clf):
     return display(HTML(nice_table(clf.get_params(), title="Hyperparameters")))
 
 
-def validation_curves(clf,x_data,y_data,cv, hyperparameters):
+memory = Memory(os.path.join(SAVED, 'Cache', 'Curves'), verbose=0)
+
+
+def curve_fold_scores(clf, data_hash, x_data, y_data, train_index, test_index):
+    '''
+    Task of the curve engine: fits clf on one fold and returns its wf1 on the train and test parts (nan if it fails to fit).
+    The data only enters the cache key through data_hash, so it is not hashed again for every task.
+    '''
+    labels = np.unique(y_data)
+    try:
+        clf = clone(clf).fit(take(x_data, train_index), y_data[train_index])
+    except Exception as error:
+        warnings.warn(f"Fitting {clf} failed: {error}. Its scores are set to nan.")
+        return np.nan, np.nan
+    scores = []
+    for index in (train_index, test_index):
+        y_pred = clf.predict(take(x_data, index))
+        scores.append(metrics(y_data[index], y_pred, labels)[1])
+    return tuple(scores)
+
+cached_curve_fold_scores = memory.cache(curve_fold_scores, ignore=['x_data', 'y_data'])
+
+
+def curve_scores(clf, x_data, y_data, cv, settings, n_jobs=-1, cache=True):
+    '''
+    The engine behind validation_curves and learning_curves: the StratifiedKFold folds are computed once and every
+    (setting, fold) task is run over n_jobs workers (all cores by default).
+    settings is a list of (params, n_train): the hyperparameters to set on clf and the number of training points of each
+    fold to use (None for all). Returns the wf1 of every setting on the train and test part of every fold, as two arrays
+    of shape (len(settings), cv).
+    With cache=True the scores are cached on disk (Saved/Cache/Curves) by the estimator with its hyperparameters, the fold and
+    a hash of the data, so only the settings that were never computed before are fitted.
+    '''
+    y_data = np.asarray(y_data)
+    folds = list(StratifiedKFold(cv).split(np.zeros((len(y_data), 1)), y_data))
+    data_hash = joblib.hash((x_data, y_data))
+    fold_scores = cached_curve_fold_scores if cache else curve_fold_scores
+    scores = Parallel(n_jobs=n_jobs)(delayed(fold_scores)(clone(clf).set_params(**params), data_hash, x_data, y_data,
+                                                          train_index[:n_train], test_index)
+                                     for params, n_train in settings for train_index, test_index in folds)
+    scores = np.array(scores, dtype=np.float64).reshape(len(settings), cv, 2)
+    return scores[:, :, 0], scores[:, :, 1]
+
+
+def validation_curve_scores(clf, x_data, y_data, cv, hyperparameters, n_jobs=-1, cache=True):
+    '''
+    The raw validation curves of all the hyperparameters at once: returns a dict with the (train_scores, test_scores) of
+    each hyperparameter, both of shape (len(values), cv) like sklearn's validation_curve.
+    '''
+    settings = [({param_name: value}, None) for param_name, param_range in hyperparameters.items() for value in param_range]
+    train_scores, test_scores = curve_scores(clf, x_data, y_data, cv, settings, n_jobs, cache)
+    curves, start = {}, 0
+    for param_name, param_range in hyperparameters.items():
+        curves[param_name] = (train_scores[start:start+len(param_range)], test_scores[start:start+len(param_range)])
+        start += len(param_range)
+    return curves
+
+
+def learning_curve_scores(clf, x_data, y_data, cv, N, n_jobs=-1, cache=True):
+    '''
+    The raw learning curve: returns the train sizes and the train and test scores, of shape (len(train_sizes), cv), like
+    sklearn's learning_curve (N holds fractions of the training folds or numbers of points).
+    '''
+    # the size of the training part of the first fold, like sklearn
+    n_max = len(next(StratifiedKFold(cv).split(np.zeros((len(y_data), 1)), y_data))[0])
+    N = np.asarray(N)
+    train_sizes = np.floor(N * n_max).astype(int) if np.issubdtype(N.dtype, np.floating) else N.astype(int)
+    train_sizes = np.unique(np.clip(train_sizes, 1, n_max))
+    train_scores, test_scores = curve_scores(clf, x_data, y_data, cv, [({}, n) for n in train_sizes], n_jobs, cache)
+    return train_sizes, train_scores, test_scores
+
+
+def validation_curves(clf,x_data,y_data,cv, hyperparameters, n_jobs=-1, cache=True):
     '''
     Plot the validation curve for a given model and hyperparameter.
+    The scores of all the hyperparameters are computed at once by the curve engine and returned (see validation_curve_scores).
     '''
+    curves = validation_curve_scores(clf, x_data, y_data, cv, hyperparameters, n_jobs, cache)
 
     categorical = False
 
@@ -194,8 +350,7 @@ def validation_curves(clf,x_data,y_data,cv, hyperparameters):
         if isinstance(param_range[0], str):
             categorical = True
 
-        train_scores, test_scores = validation_curve(clf, x_data, y_data, param_name=param_name, param_range=param_range,
-                                    cv=StratifiedKFold(cv), scoring="f1_weighted", n_jobs=4)
+        train_scores, test_scores = curves[param_name]
         
         train_scores= 1-np.mean(train_scores, axis=1)
         test_scores= 1-np.mean(test_scores, axis=1)
@@ -242,6 +397,7 @@ def validation_curves(clf,x_data,y_data,cv, hyperparameters):
 
     clear_output(wait=False) 
     plt.show()
+    return curves
 
 
 def optimal_hyperparameter(train_scores, test_scores, parameter):
@@ -267,9 +423,13 @@ def optimal_hyperparameter(train_scores, test_scores, parameter):
     patience_counter = 0
     patience=4
 
+    # running means of the scores (train_means[i-1] is the mean of train_scores[:i])
+    train_means = running_mean(train_scores)
+    test_means = running_mean(test_scores)
+
     for i in range(1, len(train_scores)):
-        train_score_curr = np.mean(train_scores[:i])  
-        test_score_curr = np.mean(test_scores[:i])  
+        train_score_curr = train_means[i-1]  
+        test_score_curr = test_means[i-1]  
 
         if train_score_curr <= train_score_prev and test_score_prev >= test_score_curr and i+1 < len(train_scores):
             if patience_counter < patience:
@@ -288,11 +448,9 @@ def BiasVariance(clf, x_data_d, y_data_d, cv=4):
     Given trained model, x_data_d, y_data_d, and cv params, it returns the bias and variance of the model.
     '''
     y_pred_train = clf.predict(x_data_d)
-    report_train = classification_report(y_data_d, y_pred_train, digits=3)  
-    train_acc, train_wf1 = get_metrics(report_train)
+    train_acc, train_wf1 = metrics(y_data_d, y_pred_train)
     y_pred_val = cross_val_predict(clf, x_data_d, y_data_d, cv=cv)
-    report_val = classification_report(y_data_d, y_pred_val, digits=3)
-    val_acc, val_wf1 = get_metrics(report_val)
+    val_acc, val_wf1 = metrics(y_data_d, y_pred_val)
     
     
     bias_var_wf1 = {
@@ -304,13 +462,13 @@ def BiasVariance(clf, x_data_d, y_data_d, cv=4):
     
     display(HTML(nice_table(bias_var_wf1, "BV Analysis Using WF1")))
 
-def learning_curves(clf, x_data, y_data, cv,N):
+def learning_curves(clf, x_data, y_data, cv,N, n_jobs=-1, cache=True):
 
     '''
     Plot the learning curve for a given model.
+    The raw train sizes and scores are returned (see learning_curve_scores).
     '''
-    train_sizes, train_scores, test_scores = learning_curve(clf, x_data, y_data, cv=StratifiedKFold(cv), n_jobs=4, 
-                                                            train_sizes=N, scoring="f1_weighted")
+    train_sizes, train_scores, test_scores = learning_curve_scores(clf, x_data, y_data, cv, N, n_jobs, cache)
 
     plt.rcParams['figure.dpi'] = 300
     plt.style.use('dark_background')
@@ -322,36 +480,242 @@ def learning_curves(clf, x_data, y_data, cv,N):
     plt.plot(train_sizes, 1- test_scores.mean(axis=1), markersize=5, label='Validation Error' )
     plt.legend(loc="best")
     plt.show()
+    return train_sizes, train_scores, test_scores
+
+
+def take(x_data, index):
+    '''
+    rows of a DataFrame or an array by position.
+    '''
+    return x_data.iloc[index] if hasattr(x_data, 'iloc') else x_data[index]
+
+
+def fit_and_predict(clf, x_data, y_data, train_index, test_index):
+    '''
+    Fits clf (a fresh clone) on the train part of a fold and predicts its test part.
+    Returns the predictions together with the time taken to fit and to predict.
+    '''
+    start = time.perf_counter()
+    clf.fit(take(x_data, train_index), y_data[train_index])
+    fit_time = time.perf_counter() - start
+    y_pred = clf.predict(take(x_data, test_index))
+    return y_pred, fit_time, time.perf_counter() - start - fit_time
+
+
+def gaussian_nb_loo(clf, x_data, y_data, block=10_000):
+    '''
+    Exact Leave-One-Out predictions of a GaussianNB in closed form: the model is fitted once and, for each point, the count,
+    mean and variance of its class (and the variance smoothing, which depends on the variance of all the data) are downdated
+    by removing the point. A class left without points can not be predicted, like when the model is refitted without it.
+    '''
+    x, y = np.asarray(x_data, dtype=np.float64), np.asarray(y_data)
+    clf = clone(clf).fit(x, y)
+    codes = np.searchsorted(clf.classes_, y)
+    n, n_classes = len(y), len(clf.classes_)
+    counts, means, variances = clf.class_count_, clf.theta_, clf.var_ - clf.epsilon_
+    total_mean = x.mean(axis=0)
+    total_m2 = ((x - total_mean)**2).sum(axis=0)
+
+    y_pred = np.empty(n, dtype=clf.classes_.dtype)
+    for lo in range(0, n, block):
+        xb, cb = x[lo:lo+block], codes[lo:lo+block]
+        rows = np.arange(len(xb))
+        # Welford downdate of the statistics of each point's own class
+        n_own = counts[cb] - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_own = (counts[cb][:, None] * means[cb] - xb) / n_own[:, None]
+            var_own = (counts[cb][:, None] * variances[cb] - (xb - means[cb]) * (xb - mean_own)) / n_own[:, None]
+        loo_mean = (n * total_mean - xb) / (n - 1)
+        loo_var = (total_m2 - (xb - total_mean) * (xb - loo_mean)) / (n - 1)
+        epsilon = clf.var_smoothing * loo_var.max(axis=1)
+
+        theta = np.repeat(means[None], len(xb), axis=0)
+        var = np.repeat(variances[None], len(xb), axis=0)
+        theta[rows, cb], var[rows, cb] = mean_own, var_own
+        var = var + epsilon[:, None, None]
+        if clf.priors is None:
+            class_counts = np.repeat(counts[None], len(xb), axis=0)
+            class_counts[rows, cb] -= 1
+            log_prior = np.log(class_counts / (n - 1))
+        else:
+            log_prior = np.log(np.repeat(clf.class_prior_[None], len(xb), axis=0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            jll = log_prior - 0.5 * np.log(2 * np.pi * var).sum(axis=2) - 0.5 * ((xb[:, None] - theta)**2 / var).sum(axis=2)
+        jll[rows, cb] = np.where(n_own > 0, jll[rows, cb], -np.inf)
+        y_pred[lo:lo+block] = clf.classes_[np.argmax(jll, axis=1)]
+    return y_pred
+
+
+def ridge_loo(clf, x_data, y_data):
+    '''
+    Exact Leave-One-Out predictions of a RidgeClassifier from the leverages of the fitted model:
+    for a linear smoother the decision value without point i is (f_i - h_i y_i) / (1 - h_i).
+    '''
+    x, y = np.asarray(x_data, dtype=np.float64), np.asarray(y_data)
+    clf = clone(clf).fit(x, y)
+    targets = clf._label_binarizer.transform(y).astype(np.float64)
+    decision = clf.decision_function(x).reshape(len(y), -1)
+    if clf.fit_intercept:
+        centered = x - x.mean(axis=0)
+        leverage = 1 / len(y)
+    else:
+        centered, leverage = x, 0
+    gram = centered.T @ centered + clf.alpha * np.eye(x.shape[1])
+    leverage = leverage + (centered @ np.linalg.inv(gram) * centered).sum(axis=1)
+    decision = (decision - leverage[:, None] * targets) / (1 - leverage[:, None])
+    if decision.shape[1] == 1:
+        return clf.classes_[(decision[:, 0] > 0).astype(int)]
+    return clf.classes_[np.argmax(decision, axis=1)]
+
+
+def logistic_loo(clf, x_data, y_data, block=10_000):
+    '''
+    Approximate Leave-One-Out predictions of an l2-penalized LogisticRegression from a single fit (leverage-based ALO):
+    removing point i moves the solution by one Newton step of the objective without it. With the Hessian H of the full
+    objective, the logits of the point move by Q (I - W Q)^-1 g where Q = K H^-1 K' is its leverage (K maps the weights
+    to its logits), W its weighted Hessian of the loss and g its weighted gradient (Woodbury's identity).
+    '''
+    x, y = np.asarray(x_data, dtype=np.float64), np.asarray(y_data)
+    clf = clone(clf).fit(x, y)
+    n = len(y)
+    x1 = np.hstack([x, np.ones((n, 1))]) if clf.fit_intercept else x
+    coef = np.hstack([clf.coef_, clf.intercept_[:, None]]) if clf.fit_intercept else clf.coef_
+    n_logits, dim = coef.shape
+    weights = clf.C * compute_sample_weight(clf.class_weight, y)
+    codes = np.searchsorted(clf.classes_, y)
+    logits = x1 @ coef.T
+    if n_logits == 1:
+        # binary: one logit for the second class
+        p = 1 / (1 + np.exp(-logits))
+        hessians = (p * (1 - p))[:, :, None]
+        residuals = p - (codes == 1)[:, None]
+    else:
+        p = np.exp(logits - logits.max(axis=1, keepdims=True))
+        p /= p.sum(axis=1, keepdims=True)
+        hessians = p[:, :, None] * np.eye(n_logits) - p[:, :, None] * p[:, None, :]
+        residuals = p - np.eye(n_logits)[codes]
+    hessians = hessians * weights[:, None, None]
+    residuals = residuals * weights[:, None]
+
+    # Hessian of the objective: the loss part block by block plus the penalty (the intercepts are not penalized)
+    hessian = np.zeros((n_logits, dim, n_logits, dim))
+    for a in range(n_logits):
+        for b in range(n_logits):
+            hessian[a, :, b, :] = (x1 * hessians[:, a, b][:, None]).T @ x1
+    penalty = np.ones(dim)
+    if clf.fit_intercept: penalty[-1] = 0
+    hessian = hessian.reshape(n_logits * dim, n_logits * dim) + np.diag(np.tile(penalty, n_logits))
+    # the softmax does not change when all intercepts shift together, pinv leaves that direction out
+    inverse = np.linalg.pinv(hessian, hermitian=True).reshape(n_logits, dim, n_logits, dim)
+
+    loo_logits = np.empty_like(logits)
+    for lo in range(0, n, block):
+        xb = x1[lo:lo+block]
+        leverage = np.einsum('id,adbe,ie->iab', xb, inverse, xb, optimize=True)
+        system = np.eye(n_logits) - hessians[lo:lo+block] @ leverage
+        shift = leverage @ np.linalg.solve(system, residuals[lo:lo+block][:, :, None])
+        loo_logits[lo:lo+block] = logits[lo:lo+block] + shift[:, :, 0]
+    if n_logits == 1:
+        return clf.classes_[(loo_logits[:, 0] > 0).astype(int)]
+    return clf.classes_[np.argmax(loo_logits, axis=1)]
+
+
+def warm_start_fold(clf, x_data, y_data, indices):
+    '''
+    Leave-One-Out predictions for the given points, each refitted starting from the full-data model clf (warm_start=True).
+    '''
+    y_pred = []
+    for i in indices:
+        model = copy.deepcopy(clf)
+        keep = np.ones(len(y_data), dtype=bool)
+        keep[i] = False
+        model.fit(take(x_data, keep), y_data[keep])
+        y_pred.append(model.predict(take(x_data, [i]))[0])
+    return y_pred
 
 
-def cross_validation(clf, x_data, y_data, k=[], n_repeats=[], random_state=1,loo=False):
+def warm_start_loo(clf, x_data, y_data, n_jobs=-1, block=100):
+    '''
+    Leave-One-Out predictions where each refit starts from the solution on all the data, so iterative solvers only need a few
+    iterations to converge; blocks of points are refitted in parallel.
+    '''
+    y = np.asarray(y_data)
+    full = clone(clf).set_params(warm_start=True).fit(x_data, y)
+    blocks = [range(lo, min(lo + block, len(y))) for lo in range(0, len(y), block)]
+    y_pred = Parallel(n_jobs=n_jobs)(delayed(warm_start_fold)(full, x_data, y, indices) for indices in blocks)
+    return np.concatenate(y_pred)
+
+
+# models whose fit continues from the current coef_ (or weights) with warm_start=True
+WARM_START_SOLVERS = (SGDClassifier, Perceptron, PassiveAggressiveClassifier, MLPClassifier)
+
+
+def loo_predict(clf, x_data, y_data, exact=False, n_jobs=-1):
+    '''
+    Leave-One-Out predictions without refitting from scratch N times when the model allows it:
+    - GaussianNB and RidgeClassifier: exact, in closed form from a single fit
+    - LogisticRegression (l2, multinomial or binary): approximate from the leverages of a single fit, unless exact is set
+    - LogisticRegression otherwise: refits warm-started from the full-data solution (its optimum does not depend on the start)
+    - other iterative solvers whose fit restarts from coef_ (SGDClassifier, Perceptron, PassiveAggressiveClassifier, MLP):
+      warm-started refits too, unless exact is set since their solution may depend on where the solver starts
+    - any other model: N refits (in parallel). Ensembles have a warm_start parameter too, but a warm-started refit with the
+      same n_estimators fits no new estimator and would give the full-data predictions back.
+    '''
+    if isinstance(clf, GaussianNB):
+        return gaussian_nb_loo(clf, x_data, y_data)
+    if isinstance(clf, RidgeClassifier) and clf.class_weight is None:
+        return ridge_loo(clf, x_data, y_data)
+    binary = len(np.unique(y_data)) == 2
+    if isinstance(clf, LogisticRegression) and not exact and clf.penalty == 'l2' and clf.solver != 'liblinear' and \
+       (clf.multi_class != 'multinomial' if binary else clf.multi_class in ('auto', 'multinomial')):
+        return logistic_loo(clf, x_data, y_data)
+    if isinstance(clf, LogisticRegression) and clf.solver != 'liblinear' or not exact and isinstance(clf, WARM_START_SOLVERS):
+        return warm_start_loo(clf, x_data, y_data, n_jobs)
+    return cross_val_predict(clf, x_data, y_data, cv=LeaveOneOut(), n_jobs=n_jobs)
+
+
+def cross_validation(clf, x_data, y_data, k=[], n_repeats=[], random_state=1,loo=False, n_jobs=-1):
     '''
     Performs cross validation on the given data and model using Leave-One-Out and Repeated K-fold.
+    Leave-One-Out uses the fast paths of loo_predict; loo='exact' rules out the approximate ones.
+    Every fold is fitted on a fresh clone of clf and the folds run in parallel over n_jobs workers.
+    The folds of a k are generated once for the largest n_repeats: the splits of RepeatedKFold with fewer repeats are the
+    first ones of it, so each fold is only fitted once and shared by all the n_repeats configurations.
+    For each configuration the returned tuple holds the wf1 and the report of the pooled predictions of all its repeats
+    and the fit and predict time of each of its folds.
     '''
 
     # Leave-One-Out cross-validation
     if loo:
-        loo_cv = LeaveOneOut()
-        y_pred = cross_val_predict(clf, x_data, y_data, cv=loo_cv)
+        y_pred = loo_predict(clf, x_data, y_data, exact=(loo == 'exact'), n_jobs=n_jobs)
         loo_report = classification_report(y_data, y_pred, digits=4)
-        _, loo_wf1 = get_metrics(loo_report)
+        _, loo_wf1 = metrics(y_data, y_pred)
         loo_dict = { 'loo_wf1': loo_wf1, 'loo_report': loo_report}
 
     # Repeated K-fold cross-validation
-    kfold = {} # key=(k, n_repeats), value=(wf1, report)
+    y_data = np.asarray(y_data)
+    labels = np.unique(y_data)
+    folds = {}  # key=k, value=list of (train_index, test_index) of all the repeats
+    for k_i in k:
+        rkf = RepeatedKFold(n_splits=k_i, n_repeats=max(n_repeats, default=0), random_state=random_state)
+        folds[k_i] = list(rkf.split(np.zeros((len(y_data), 1))))
+    tasks = [(k_i, fold) for k_i in k for fold in folds[k_i]]
+    results = Parallel(n_jobs=n_jobs)(delayed(fit_and_predict)(clone(clf), x_data, y_data, train_index, test_index)
+                                      for _, (train_index, test_index) in tasks)
+    results = iter(results)
+    results = {k_i: [next(results) for _ in folds[k_i]] for k_i in k}
+
+    kfold = {} # key=(k, n_repeats), value=(wf1, report, timings)
     for i in range(len(k)):
         for j in range(len(n_repeats)):
-            rkf = RepeatedKFold(n_splits=k[i], n_repeats=n_repeats[j], random_state=random_state)
-            y_pred = np.zeros(len(y_data))  # prediction array 
-            for train_index, test_index in rkf.split(x_data): 
-                x_train, x_test = x_data.iloc[train_index], x_data.iloc[test_index] 
-                y_train, _ = y_data[train_index], y_data[test_index]
-                clf.fit(x_train, y_train)
-                y_pred[test_index] = clf.predict(x_test)
-
-            report = classification_report(y_data, y_pred, digits=4)
-            _, wf1 = get_metrics(report)
-            kfold[f'{n_repeats[j]}-Repeated {k[i]}-fold'] = ( wf1, report)
+            n_folds = k[i] * n_repeats[j]
+            y_true = np.concatenate([y_data[test_index] for _, test_index in folds[k[i]][:n_folds]])
+            y_pred = np.concatenate([y_fold for y_fold, _, _ in results[k[i]][:n_folds]])
+            _, wf1 = metrics(y_true, y_pred, labels)
+            report = classification_report(y_true, y_pred, digits=4)
+            timings = {'fit': np.array([fit_time for _, fit_time, _ in results[k[i]][:n_folds]]),
+                       'predict': np.array([predict_time for _, _, predict_time in results[k[i]][:n_folds]])}
+            kfold[f'{n_repeats[j]}-Repeated {k[i]}-fold'] = ( wf1, report, timings)
 
     # Create table for wf1
     if loo:     wf1_results = {'loo_wf1': loo_wf1}
@@ -365,8 +729,111 @@ def cross_validation(clf, x_data, y_data, k=[], n_repeats=[], random_state=1,loo
     else:   return kfold
     
 
+def fit_and_score(clf, params, resource, amount, x_data, y_data, train_index, test_index, random_state):
+    '''
+    Trial of the hyperparameter search: the weighted F1 on one fold of clf with the given hyperparameters and budget
+    (amount training points if resource is 'n_samples', else the value of the resource hyperparameter).
+    '''
+    clf = clone(clf).set_params(**params)
+    if resource == 'n_samples':
+        # the same subsample of each fold for every candidate
+        train_index = train_index[np.random.default_rng(random_state).permutation(len(train_index))[:amount]]
+    else:
+        clf.set_params(**{resource: amount})
+    clf.fit(take(x_data, train_index), y_data[train_index])
+    y_pred = clf.predict(take(x_data, test_index))
+    labels = np.unique(y_data)
+    return metrics(y_data[test_index], y_pred, labels)[1]
+
+
+def halving_search(clf, params, x_data, y_data, model_name, n_candidates=50, resource='n_samples', min_resource=None,
+                   max_resource=None, factor=3, cv=5, min_folds=2, hyperband=False, random_state=1, n_jobs=-1):
+    '''
+    Successive halving (or Hyperband) hyperparameter search that checkpoints every trial in Saved/{model_name}_search.pkl.
+    - Candidates are sampled from params (as in RandomizedSearchCV) and evaluated with a budget that grows by factor from
+      min_resource to max_resource; only the best 1/factor of them are promoted to the next budget.
+    - The budget is the number of training points (resource='n_samples') or the value of a hyperparameter like n_estimators.
+    - At each budget every candidate runs min_folds folds first; those whose mean wf1 is more than two standard errors below
+      the wf1 needed for promotion are pruned without running the remaining folds.
+    - With hyperband=True several such brackets are run, trading the number of candidates for the starting budget.
+    The checkpoint is reused when the same search (same estimator configuration, data and settings) is run again, so an
+    interrupted search resumes where it stopped.
+    The best hyperparameters (at max_resource) are saved with save_hyperparameters and returned along with all the results.
+    '''
+    y_data = np.asarray(y_data)
+    folds = list(StratifiedKFold(cv, shuffle=True, random_state=random_state).split(np.zeros((len(y_data), 1)), y_data))
+    if resource == 'n_samples':
+        max_resource = max_resource or min(len(train_index) for train_index, _ in folds)
+        min_resource = min_resource or 2 * cv * len(np.unique(y_data))
+    s_max = int(math.floor(math.log(max_resource / min_resource, factor) + 1e-9))
+
+    # brackets of (candidates, budgets): one for successive halving, s_max + 1 for Hyperband
+    brackets = []
+    for s in (range(s_max, -1, -1) if hyperband else [s_max]):
+        n = int(math.ceil((s_max + 1) / (s + 1) * factor**s)) if hyperband else n_candidates
+        candidates = list(ParameterSampler(params, n, random_state=random_state + s))
+        amounts = [max_resource * factor**(i - s) for i in range(s + 1)]
+        if isinstance(max_resource, (int, np.integer)):
+            amounts = [max(int(round(a)), 1) for a in amounts]
+        brackets.append((candidates, amounts))
+
+    # the checkpoint only holds for the same estimator configuration on the same data
+    base_params = sorted((name, repr(value)) for name, value in clf.get_params(deep=False).items())
+    signature = hashlib.sha1(repr((type(clf).__name__, base_params, joblib.hash((x_data, y_data)), brackets, resource, cv,
+                                   min_folds, random_state)).encode()).hexdigest()
+    search = load_search(model_name)
+    if search is None or search['signature'] != signature:
+        search = {'signature': signature, 'trials': {}}
+    trials = search['trials']  # key=(bracket, candidate, rung, fold), value=wf1
+
+    def run(tasks):
+        todo = [task for task in tasks if task not in trials]
+        scores = Parallel(n_jobs=n_jobs, return_as='generator')(
+            delayed(fit_and_score)(clf, brackets[b][0][c], resource, brackets[b][1][r], x_data, y_data, *folds[f], random_state + f)
+            for b, c, r, f in todo)
+        for task, score in zip(todo, scores):
+            trials[task] = score
+            save_search(model_name, search)
+
+    results = []
+    for b, (candidates, amounts) in enumerate(brackets):
+        alive = list(range(len(candidates)))
+        for r, amount in enumerate(amounts):
+            n_keep = 1 if r == len(amounts) - 1 else int(math.ceil(len(alive) / factor))
+            run([(b, c, r, f) for c in alive for f in range(min(min_folds, cv))])
+            if min_folds < cv:
+                partial = {c: np.array([trials[(b, c, r, f)] for f in range(min_folds)]) for c in alive}
+                threshold = sorted((scores.mean() for scores in partial.values()), reverse=True)[n_keep - 1]
+                error = lambda scores: 2 * scores.std(ddof=1) / np.sqrt(len(scores)) if len(scores) > 1 else 0
+                alive = [c for c in alive if partial[c].mean() + error(partial[c]) >= threshold]
+                run([(b, c, r, f) for c in alive for f in range(min_folds, cv)])
+            means = {c: np.mean([trials[(b, c, r, f)] for f in range(cv)]) for c in alive}
+            for c in alive:
+                results.append({'bracket': b, 'params': candidates[c], resource: amount, 'wf1': means[c]})
+            alive = sorted(alive, key=lambda c: means[c], reverse=True)[:n_keep]
+
+    best = max((result for result in results if result[resource] == brackets[0][1][-1]), key=lambda result: result['wf1'])
+    opt_params = dict(best['params'])
+    if resource != 'n_samples': opt_params[resource] = best[resource]
+    save_hyperparameters(model_name, opt_params)
+    display(HTML(nice_table({**opt_params, 'wf1': best['wf1']}, "Optimal Hyperparameters")))
+    return opt_params, results
+
+
 def svm_score(clf, X, y):
     clf.fit(X, y)
     n_support = np.sum(clf.n_support_)
     return - n_support
 
+
+if __name__ == '__main__':
+    # regression check: the fast Leave-One-Out predictions must be those of N refits from scratch whenever they claim to be
+    from sklearn.datasets import make_classification
+    from sklearn.ensemble import RandomForestClassifier, BaggingClassifier, ExtraTreesClassifier
+    x_data, y_data = make_classification(n_samples=60, n_features=5, n_informative=3, n_classes=3, random_state=0)
+    for clf in [RandomForestClassifier(n_estimators=10, random_state=0), BaggingClassifier(n_estimators=10, random_state=0),
+                ExtraTreesClassifier(n_estimators=10, random_state=0), GaussianNB(), RidgeClassifier()]:
+        y_fast = loo_predict(clf, x_data, y_data)
+        y_brute = cross_val_predict(clf, x_data, y_data, cv=LeaveOneOut())
+        assert np.array_equal(y_fast, y_brute), f'fast Leave-One-Out of {type(clf).__name__} differs from N refits'
+        print(f'{type(clf).__name__}: fast Leave-One-Out matches N refits (accuracy {np.mean(y_fast == y_data):.3f})')
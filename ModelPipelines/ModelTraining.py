@@ -0,0 +1,30 @@
+import numpy as np
+import sys
+sys.path.append("../../")
+from DataPreparation.DataPreparation import fit_stream, read_batches
+
+
+def stream_fit(clf, batches, classes, epochs=5):
+    '''
+    Train an estimator that supports partial_fit (SGDClassifier, Perceptron, ...) over several epochs of mini-batches.
+    batches is called with the epoch number and must return a fresh iterator over (x_batch, y_batch).
+    '''
+    for epoch in range(epochs):
+        for x_batch, y_batch in batches(epoch):
+            clf.partial_fit(x_batch, y_batch, classes=classes)
+    return clf
+
+
+def stream_train(clf, kind=None, encode=None, split="train", epochs=5, batch_size=1024, chunksize=100_000, random_state=None):
+    '''
+    Out-of-core counterpart of fitting clf on read_data(kind, encode, split): the preprocessor is fitted in one streaming
+    pass and clf is then trained on shuffled mini-batches read chunk by chunk, so memory does not grow with the data.
+    Returns the trained model and the fitted preprocessor (needed to prepare data for it later).
+    '''
+    preprocessor, classes = fit_stream(kind, encode, split, chunksize)
+    seed = np.random.SeedSequence(random_state)
+    # a different (but reproducible) chunk and row order in every epoch
+    seeds = [np.random.default_rng(child) for child in seed.spawn(epochs)]
+    batches = lambda epoch: read_batches(preprocessor, classes, kind, split, batch_size, chunksize, shuffle=True, random_state=seeds[epoch])
+    clf = stream_fit(clf, batches, np.arange(len(classes)), epochs)
+    return clf, preprocessor
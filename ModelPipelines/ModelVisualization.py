@@ -5,10 +5,203 @@ import numpy as np
 import matplotlib
 from IPython.display import Image as Im
 from IPython.display import display
-import imageio
 from tqdm import tqdm
 import os
-from PIL import Image, ImageOps
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image, ImageOps, ImageSequence, GifImagePlugin
+from joblib import Memory
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import SAVED
+
+# label rasters of the decision regions, keyed by the fitted model, the grid bounds and the resolution
+memory = Memory(os.path.join(SAVED, 'Cache', 'Regions'), verbose=0)
+
+
+def split_thresholds(clf, n_features=2):
+    '''
+    The sorted split thresholds on each feature of a tree model (a decision tree, RandomForest, ExtraTrees, AdaBoost or
+    gradient boosting of trees), across which alone its prediction can change; None for any other model.
+    '''
+    if hasattr(clf, 'tree_'):
+        trees = [clf]
+    elif type(clf).__name__ in ('RandomForestClassifier', 'ExtraTreesClassifier', 'AdaBoostClassifier', 'GradientBoostingClassifier'):
+        trees = list(np.ravel(clf.estimators_))
+    else:
+        return None
+    if not all(hasattr(tree, 'tree_') for tree in trees): return None
+    return [np.sort(np.concatenate([tree.tree_.threshold[tree.tree_.feature == f] for tree in trees])) for f in range(n_features)]
+
+
+def decision_raster(clf, x1_min, x1_max, x2_min, x2_max, step=0.01, coarse=32):
+    '''
+    The prediction of clf at every point of np.meshgrid(np.arange(x1_min, x1_max, step), np.arange(x2_min, x2_max, step))
+    without predicting most of them: the grid is first predicted on a lattice about coarse cells wide, then each level
+    halves the spacing and only predicts the new points that touch a cell that may hold a boundary (a quadtree refinement of
+    the region boundaries). Points inside the other cells get the label of their corners.
+    - tree models: a cell may hold a boundary if its corners disagree or a split threshold crosses it, so the raster is exact
+    - other models: a cell may hold a boundary if its corners, or those of a neighbouring cell, disagree. A region that no
+      lattice point falls in and that does not reach a refined cell is still missed (it takes a region narrower than the
+      coarse spacing, e.g. the islands of a KNN around single points).
+    returns the raster of labels and the number of points that were predicted.
+    '''
+    x1, x2 = np.arange(x1_min, x1_max, step), np.arange(x2_min, x2_max, step)
+    # the coarsest spacing S is a power of two and the lattice is padded to a multiple of it (cropped at the end)
+    S = 2 ** max(int(np.log2(max(len(x1), len(x2)) / coarse)), 0)
+    n2, n1 = -(-(len(x2) - 1) // S) * S + 1, -(-(len(x1) - 1) // S) * S + 1
+    codes = np.full((n2, n1), -1, dtype=np.int16)
+    classes = clf.classes_
+    thresholds = split_thresholds(clf)
+    if thresholds is not None:
+        # the number of thresholds below each lattice coordinate (sklearn compares the float32 features with them)
+        below1 = np.searchsorted(thresholds[0], (x1_min + np.arange(n1) * step).astype(np.float32))
+        below2 = np.searchsorted(thresholds[1], (x2_min + np.arange(n2) * step).astype(np.float32))
+
+    def predict(rows, cols):
+        points = np.c_[x1_min + cols * step, x2_min + rows * step]
+        codes[rows, cols] = np.searchsorted(classes, clf.predict(points))
+        return len(rows)
+
+    rows, cols = np.meshgrid(np.arange(0, n2, S), np.arange(0, n1, S), indexing='ij')
+    n_predicted = predict(rows.ravel(), cols.ravel())
+    s = S
+    while s > 1:
+        h = s // 2
+        lattice = codes[::s, ::s]
+        corner = lattice[:-1, :-1]
+        uniform = np.ones((lattice.shape[0] + 1, lattice.shape[1] + 1), dtype=bool)
+        disagree = (corner != lattice[1:, :-1]) | (corner != lattice[:-1, 1:]) | (corner != lattice[1:, 1:])
+        if thresholds is not None:
+            # a cell is uniform when no threshold lies in [its first coordinate, its last one)
+            crossed1, crossed2 = np.diff(below1[::s]) > 0, np.diff(below2[::s]) > 0
+            uniform[1:-1, 1:-1] = ~(disagree | crossed2[:, None] | crossed1[None, :])
+        else:
+            # the cells next to a boundary are refined too, so regions that cross them between two corners are not missed
+            padded = np.pad(disagree, 1)
+            near = np.zeros_like(disagree)
+            for dr in range(3):
+                for dc in range(3):
+                    near |= padded[dr:dr + disagree.shape[0], dc:dc + disagree.shape[1]]
+            uniform[1:-1, 1:-1] = ~near
+        # the new points: cell centers, midpoints of vertical edges and midpoints of horizontal edges, with the
+        # cells they touch (a point on the border of the grid only touches one cell)
+        centers = np.meshgrid(np.arange(corner.shape[0]), np.arange(corner.shape[1]), indexing='ij')
+        vertical = np.meshgrid(np.arange(corner.shape[0]), np.arange(lattice.shape[1]), indexing='ij')
+        horizontal = np.meshgrid(np.arange(lattice.shape[0]), np.arange(corner.shape[1]), indexing='ij')
+        new_points = [
+            (centers[0] * s + h, centers[1] * s + h, uniform[1:-1, 1:-1], corner),
+            (vertical[0] * s + h, vertical[1] * s, uniform[1:-1, :-1] & uniform[1:-1, 1:], lattice[:-1, :]),
+            (horizontal[0] * s, horizontal[1] * s + h, uniform[:-1, 1:-1] & uniform[1:, 1:-1], lattice[:, :-1]),
+        ]
+        refine_rows, refine_cols = [], []
+        for r, c, agree, label in new_points:
+            codes[r[agree], c[agree]] = label[agree]
+            refine_rows.append(r[~agree])
+            refine_cols.append(c[~agree])
+        n_predicted += predict(np.concatenate(refine_rows), np.concatenate(refine_cols))
+        s = h
+    return classes[codes[:len(x2), :len(x1)]], n_predicted
+
+cached_decision_raster = memory.cache(decision_raster)
+
+
+class GifWriter:
+    '''
+    Writes a looping GIF one frame at a time, so only the frame being written is ever in memory.
+    Every frame is mapped onto the 256-color palette of the first one (the GIF's global color table).
+        with GifWriter(path, fps) as writer:
+            for frame in frames: writer.append(frame)
+    '''
+    def __init__(self, path, fps):
+        self.file = open(path, 'wb')
+        self.duration = 1000 / fps
+        self.palette = None
+
+    def append(self, frame):
+        image = Image.fromarray(np.asarray(frame)[..., :3])
+        if self.palette is None:
+            self.palette = image.quantize(256)
+            image = self.palette.copy()
+            header, _ = GifImagePlugin.getheader(image, info={'loop': 0, 'duration': self.duration, 'optimize': False})
+            self.file.writelines(header)
+        else:
+            image = image.quantize(palette=self.palette, dither=Image.Dither.NONE)
+        self.file.writelines(GifImagePlugin.getdata(image, duration=self.duration))
+
+    def close(self):
+        self.file.write(b';')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def draw_3D(fig, x_data_r, y_data_r, names):
+    '''
+    Draws the 3D scatter of the points in x_data_r with the labels in y_data_r on fig and returns its axes.
+    '''
+    ax = fig.add_subplot(111, projection='3d')
+    ax.grid(False)                                                          # remove grid
+    ax.xaxis.pane.fill = ax.yaxis.pane.fill = ax.zaxis.pane.fill = False    # remove principal planes
+    ax.set_axis_off()                                                       # remove axis              
+    f1, f2, f3 = names                                                      # get feature names
+    ax.set_title(f'Plotting {f1} (x) vs {f2} (y) vs {f3} (z)', fontsize=10) # add title
+    
+    # Scatter Plot the Data
+    colors = np.array(['#799FFA', '#ffff00', '#5fff4a', '#f781bf'])
+    scatter = ax.scatter(x_data_r[:,0], x_data_r[:,1], x_data_r[:,2], c=y_data_r, cmap=matplotlib.colors.ListedColormap(colors))
+    
+    # Increase the vertical scale (z axis)
+    ax.get_proj = lambda: np.dot(Axes3D.get_proj(ax), np.diag([1, 1, 1.5, 1]))
+    
+    # Add a legend for the classes
+    legend_elements = [(marker, label) for marker, label in zip(scatter.legend_elements()[0], ['Body Level 0', 'Body Level 1', 'Body Level 2', 'Body Level 3'])]
+    ax.legend(*zip(*legend_elements), loc='lower center', bbox_to_anchor=(0.5, 0.0), ncol=4, fontsize=6)
+    return ax
+
+# the figure of a frame rendering worker, drawn once by init_renderer
+RENDERER = {}
+
+def init_renderer(x_data_r, y_data_r, names, dpi=200):
+    '''
+    Draws the 3D plot once on an off-screen Agg figure (no pyplot state is involved) that render_frame then rotates.
+    '''
+    matplotlib.style.use('dark_background')
+    fig = Figure(dpi=dpi)
+    FigureCanvasAgg(fig)
+    RENDERER['fig'], RENDERER['ax'] = fig, draw_3D(fig, x_data_r, y_data_r, names)
+
+def render_frame(azim):
+    '''
+    The RGB image of the plot seen from the azimuth azim.
+    '''
+    fig, ax = RENDERER['fig'], RENDERER['ax']
+    ax.view_init(azim=azim, elev=0)
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+
+def render_frames(x_data_r, y_data_r, names, azims, workers=None):
+    '''
+    Yields the frames of the given azimuths in order, rendered by a pool of workers (os.cpu_count() by default).
+    At most two frames per worker are in flight, so memory does not grow with the number of frames.
+    '''
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        init_renderer(x_data_r, y_data_r, names)
+        yield from map(render_frame, azims)
+        return
+    with ProcessPoolExecutor(workers, initializer=init_renderer, initargs=(x_data_r, y_data_r, names)) as pool:
+        pending = collections.deque()
+        for azim in azims:
+            pending.append(pool.submit(render_frame, azim))
+            if len(pending) > 2 * workers: yield pending.popleft().result()
+        while pending: yield pending.popleft().result()
 
 class VisualizeModel():
     '''
@@ -26,61 +219,37 @@ class VisualizeModel():
         self.filename = name
         self.clf = clf
 
-    def illustrate_features_3D(self, animated=False, show=False):
+    def illustrate_features_3D(self, animated=False, show=False, workers=None):
         '''
         Show a 3D plot of the feature space using the points in x_data and the labels in y_data
+        The frames of the animation are rendered in parallel by workers processes and streamed into the GIF.
         '''
         x_data_r, y_data_r = self.x_data.values, self.y_data
         self.clf.fit(x_data_r, y_data_r)                                        # fit the classifier
-        
-        # Basic Plot Setup
-        plt.style.use('dark_background')                                        # dark background           
-        fig = plt.figure()
-        fig.set_dpi(200)                                                        # increase resolution
-        ax = fig.add_subplot(111, projection='3d')
-        ax.grid(False)                                                          # remove grid
-        ax.xaxis.pane.fill = ax.yaxis.pane.fill = ax.zaxis.pane.fill = False    # remove principal planes
-        ax.set_axis_off()                                                       # remove axis              
-        f1, f2, f3 = self.x_data.columns                                        # get feature names
-        ax.set_title(f'Plotting {f1} (x) vs {f2} (y) vs {f3} (z)', fontsize=10) # add title
-        
-        # Scatter Plot the Data
-        colors = np.array(['#799FFA', '#ffff00', '#5fff4a', '#f781bf'])
-        scatter = ax.scatter(x_data_r[:,0], x_data_r[:,1], x_data_r[:,2], c=y_data_r, cmap=matplotlib.colors.ListedColormap(colors))
-        
-        # Increase the vertical scale (z axis)
-        ax.get_proj = lambda: np.dot(Axes3D.get_proj(ax), np.diag([1, 1, 1.5, 1]))
-        
-        # Add a legend for the classes
-        legend_elements = [(marker, label) for marker, label in zip(scatter.legend_elements()[0], ['Body Level 0', 'Body Level 1', 'Body Level 2', 'Body Level 3'])]
-        ax.legend(*zip(*legend_elements), loc='lower center', bbox_to_anchor=(0.5, 0.0), ncol=4, fontsize=6)
+        names = list(self.x_data.columns)
         
         if not animated and show:
-            plt.show()                  # Show a static plot (code above is enough)
+            # Show a static plot
+            plt.style.use('dark_background')                                    # dark background           
+            fig = plt.figure()
+            fig.set_dpi(200)                                                    # increase resolution
+            draw_3D(fig, x_data_r, y_data_r, names)
+            plt.show()
         else:
-            plt.close()
-            frames = []
             step = 4
             num_frames = 360//step
-            for i in tqdm(range(num_frames)):
-                ax.view_init(azim=i*step, elev=0)
-                # generate the figure in memory without showing
-                fig.canvas.draw()                     
-                # convert the saved figure to a 1D numpy array                             
-                frame = np.frombuffer(fig.canvas.tostring_rgb(), dtype=np.uint8)   
-                # ... 3D numpy array (width, height)->(height, width)->(height, width, 3)
-                frame = frame.reshape(fig.canvas.get_width_height()[::-1] + (3,))  
-                # append it into the list of frames that make up the gif
-                frames.append(frame)   
-                                                                                
-            # save the list of images as an animated GIF
+            azims = [i*step for i in range(num_frames)]
+            # save the frames as an animated GIF (15 frames per second) as soon as each is rendered
             path = f'../../Saved/{self.filename}.gif' 
-            imageio.mimsave(path, frames,format='gif', fps=self.fps)          # make a gif out of the frames where there are 15 frames per second
+            with GifWriter(path, self.fps) as writer:
+                for frame in tqdm(render_frames(x_data_r, np.asarray(y_data_r), names, azims, workers), total=num_frames):
+                    writer.append(frame)
             if show:    display(Im(path))
 
-    def illustrate_features_2D(self, show=False):
+    def illustrate_features_2D(self, show=False, cache=True):
         '''
         Show 2D plot with decision regions
+        The regions are rendered with decision_raster and, if cache, reused when the same fitted model is plotted again.
         '''
         # Take the two top-most features
         x_data_r, y_data_r = self.x_data.iloc[:,1:].values, self.y_data
@@ -91,9 +260,8 @@ class VisualizeModel():
         x2_min, x2_max = x_data_r[:, 1].min() - 1, x_data_r[:, 1].max() + 1
         x1x1, x2x2 = np.meshgrid(np.arange(x1_min, x1_max, 0.01), np.arange(x2_min, x2_max, 0.01))
 
-        # Predict for all points in the grid
-        Z = self.clf.predict(np.c_[x1x1.ravel(), x2x2.ravel()]) 
-        Z = Z.reshape(x1x1.shape)
+        # Predict the grid (only around the boundaries of the regions)
+        Z, _ = (cached_decision_raster if cache else decision_raster)(self.clf, x1_min, x1_max, x2_min, x2_max, 0.01)
 
         # Plot
         ax = plt.figure().add_subplot(111)
@@ -118,8 +286,8 @@ class VisualizeModel():
         '''
         Create a gif that shows both PCA and UMAP dimensionality reduction techniques by:
         1 - Checking if the gifs already exist or if they need to be created
-        2 - Reading the two gifs and converting to numpy arrays and adjust their sizes
-        3 - Concatenating them along the width axis (horizontally)
+        2 - Reading the 2D image and adjusting its size to the frames of the 3D gif
+        3 - Concatenating each frame with it along the width axis (horizontally), one frame at a time
         4 - Saving and displaying the gif
         '''
         # If they are not saved and useOld is true then read them
@@ -128,29 +296,21 @@ class VisualizeModel():
         if not os.path.exists(f'../../Saved/{self.filename}.png') or not useOld:
             self.illustrate_features_2D(show=False)
             
-        # Read the two gifs
-        gif1 = imageio.mimread(f'../../Saved/{self.filename}.gif', memtest=False)
+        # Read the 2D image and adjust its size to the frames of the 3D gif (must have same height)
+        gif1 = Image.open(f'../../Saved/{self.filename}.gif')
         gif2 = Image.open(f'../../Saved/{self.filename}.png')
-        gif1 = np.array([frame[:, :, :3] for frame in gif1])  # remove alpha channel
-        gif2 = np.array(gif2)
-                
-        # Adjusting the size of the two gifs (must have same height) and number of frames
-        h1 = gif1.shape[1]                      # height of the 3d gif
-        h2, w2 = gif2.shape[:2]                 # height and width of the 2d gif
-        wnew = int(w2 * h1 / h2)                # new width of the 2d gif after h2 = h1
-        gif2 = Image.fromarray(gif2)
+        h1 = gif1.height                        # height of the 3d gif
+        w2, h2 = gif2.size                      # width and height of the 2d image
+        wnew = int(w2 * h1 / h2)                # new width of the 2d image after h2 = h1
         # Pad it with black pixels so it's not too big
         gif2 = ImageOps.expand(gif2, border=60, fill='black')
         # Now do the resizing
         gif2 = gif2.resize((wnew, h1), resample=Image.Resampling.BICUBIC)   
-        gif2 = np.array(gif2)
-
-        # repeat the 2d image along a new axis which will be 0 so it matches the 3d image
-        gif2 = np.repeat(gif2[np.newaxis, ...], gif1.shape[0], axis=0)
-
-        # Concatenate the two gifs along the width axis
-        gif = np.concatenate((gif1, gif2[..., :3]), axis=2)  # remove alpha channel from gif2
+        gif2 = np.array(gif2)[..., :3]          # remove alpha channel
 
-        # Save and display the gif
-        imageio.mimsave(f'../../Saved/{self.filename}-D.gif', gif, fps=self.fps if animated else 0.1)
-        display(Im(f'../../Saved/{self.filename}-D.gif'))
\ No newline at end of file
+        # Concatenate each frame of the 3D gif with the 2D image along the width axis, one frame at a time
+        path = f'../../Saved/{self.filename}-D.gif'
+        with GifWriter(path, self.fps if animated else 0.1) as writer:
+            for frame in ImageSequence.Iterator(gif1):
+                writer.append(np.concatenate((np.asarray(frame.convert('RGB')), gif2), axis=1))
+        display(Im(path))
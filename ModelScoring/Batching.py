@@ -0,0 +1,106 @@
+'''
+Dynamic micro-batching in front of a model: the rows of concurrent requests are gathered for at most max_wait_ms (or until
+max_rows rows are waiting) and scored with a single vectorized call, then each caller gets its own part of the result.
+sklearn ensembles cost about as much to call on 1 row as on hundreds, so this multiplies throughput under concurrent load.
+    scheduler = BatchScheduler(functools.partial(predict, model))
+    y_pred = scheduler.predict(x_test)               # from any thread
+    y_pred = await scheduler.predict_async(x_test)   # from a coroutine
+'''
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+import pandas as pd
+
+
+def concat(parts):
+    return pd.concat(parts) if isinstance(parts[0], pd.DataFrame) else np.concatenate(parts)
+
+
+def split(result, start, end):
+    '''
+    the rows start:end of a batch result: an array or a tuple whose arrays are split (anything else is shared).
+    '''
+    if isinstance(result, tuple):
+        return tuple(split(part, start, end) for part in result)
+    if isinstance(result, (np.ndarray, pd.DataFrame, pd.Series, list)):
+        return result[start:end]
+    return result
+
+
+class BatchScheduler:
+    '''
+    Scores the requests submitted from any number of threads or coroutines in batches with predict_fn, which takes the
+    concatenated inputs (DataFrames or arrays) and returns an array, or a tuple of arrays, with one row per input row.
+    A batch is scored as soon as max_rows rows are waiting or max_wait_ms have passed since its first request arrived.
+    '''
+    def __init__(self, predict_fn, max_rows=256, max_wait_ms=2.0):
+        self.predict_fn = predict_fn
+        self.max_rows = max_rows
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.batched_rows = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, x_test):
+        '''
+        Queues x_test and returns a concurrent.futures.Future of its result.
+        '''
+        future = Future()
+        self.requests.put((x_test, future))
+        return future
+
+    def predict(self, x_test):
+        return self.submit(x_test).result()
+
+    async def predict_async(self, x_test):
+        return await asyncio.wrap_future(self.submit(x_test))
+
+    def close(self):
+        '''
+        Stops the scheduler once the requests already queued are scored.
+        '''
+        self.requests.put(None)
+        self.thread.join()
+
+    def collect(self):
+        '''
+        Waits for a request, then gathers more until the batch is full or its time is up. Returns None when closed.
+        '''
+        first = self.requests.get()
+        if first is None: return None
+        batch, rows = [first], len(first[0])
+        deadline = time.perf_counter() + self.max_wait
+        while rows < self.max_rows:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # score what is gathered, then stop
+                self.requests.put(None)
+                break
+            batch.append(request)
+            rows += len(request[0])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            if batch is None: return
+            try:
+                result = self.predict_fn(concat([x_test for x_test, _ in batch]))
+            except Exception as error:
+                for _, future in batch: future.set_exception(error)
+                continue
+            start = 0
+            for x_test, future in batch:
+                future.set_result(split(result, start, start + len(x_test)))
+                start += len(x_test)
+            self.batches += 1
+            self.batched_rows += start
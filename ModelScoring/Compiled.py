@@ -0,0 +1,448 @@
+'''
+Exports a fitted model into a flat NumPy-only representation and predicts with it without sklearn:
+    python Compiled.py --model StackingEnsemble.pkl --output StackingEnsembleLean
+- SVC: the support vectors and one dual coefficient column per pair of classes (any kernel), with the Platt scaling of
+  each pair when it was trained with probability=True
+- linear models (LogisticRegression, Perceptron, SGD, Ridge): the weight matrix and the intercepts
+- decision trees, RandomForest and AdaBoost (of decision trees): all the trees as one set of node arrays
+- StackingClassifier: its base estimators and final estimator, recursively
+The representation is a JSON-able spec (the structure, hyperparameters and classes) plus a dict of named arrays, saved as one
+.npy file per array that is memory-mapped back on load (so worker processes share the weights instead of copying them).
+The model registry (Registry.py) saves this export along with every model that has one.
+The computations follow the ones of sklearn (and libsvm) step by step so the predictions are the same as the pickle's.
+'''
+import argparse
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+
+# rows evaluated at once by the trees (their traversal holds a (rows, trees) matrix of nodes)
+TREE_BLOCK = 1024
+
+
+#---------------------------------------------------------------------------------
+# Export
+
+def export(model):
+    '''
+    Returns the spec of model and the dict of arrays it refers to (by name).
+    '''
+    arrays = {}
+    return export_spec(model, arrays, 'model'), arrays
+
+
+def export_spec(model, arrays, prefix):
+    '''
+    The spec of model, whose arrays are added to arrays under names starting with prefix.
+    '''
+    kind = type(model).__name__
+    spec = {'type': kind}
+    if hasattr(model, 'classes_'):
+        # string labels are kept as a fixed-width string array (object arrays can not be memory-mapped)
+        classes = np.asarray(model.classes_)
+        arrays[f'{prefix}.classes'] = classes.astype(str) if classes.dtype == object else classes
+        spec['classes'] = f'{prefix}.classes'
+    if hasattr(model, 'feature_names_in_'):
+        spec['features'] = [str(feat) for feat in model.feature_names_in_]
+
+    if kind == 'StackingClassifier':
+        spec['estimators'] = [export_spec(estimator, arrays, f'{prefix}.estimators.{i}') if estimator != 'drop' else None
+                              for i, estimator in enumerate(model.estimators_)]
+        spec['stack_method'] = list(model.stack_method_)
+        spec['passthrough'] = bool(model.passthrough)
+        spec['final'] = export_spec(model.final_estimator_, arrays, f'{prefix}.final')
+    elif kind == 'SVC':
+        export_svc(model, spec, arrays, prefix)
+    elif hasattr(model, 'coef_') and hasattr(model, 'intercept_'):
+        spec['type'] = 'linear'
+        spec['model'] = kind
+        spec['proba'] = linear_proba(model)
+        arrays[f'{prefix}.coef'] = np.asarray(model.coef_, dtype=np.float64)
+        arrays[f'{prefix}.intercept'] = np.atleast_1d(np.asarray(model.intercept_, dtype=np.float64))
+        spec['coef'], spec['intercept'] = f'{prefix}.coef', f'{prefix}.intercept'
+    elif kind == 'DecisionTreeClassifier':
+        spec['forest'] = export_trees([model], arrays, prefix)
+    elif kind in ('RandomForestClassifier', 'ExtraTreesClassifier'):
+        spec['type'] = 'forest'
+        spec['forest'] = export_trees(model.estimators_, arrays, prefix)
+    elif kind == 'AdaBoostClassifier':
+        for base in model.estimators_:
+            if type(base).__name__ != 'DecisionTreeClassifier':
+                raise ValueError(f'{kind} with {type(base).__name__} can not be exported')
+        spec['algorithm'] = model.algorithm
+        spec['forest'] = export_trees(model.estimators_, arrays, prefix)
+        arrays[f'{prefix}.weights'] = np.asarray(model.estimator_weights_[:len(model.estimators_)], dtype=np.float64)
+        spec['weights'] = f'{prefix}.weights'
+    else:
+        raise ValueError(f'{kind} can not be exported')
+    return spec
+
+
+def linear_proba(model):
+    '''
+    how a linear model turns its decision into probabilities: 'softmax', 'ovr' (normalized sigmoids), 'modified_huber'
+    (normalized clipped decisions) or None.
+    '''
+    if type(model).__name__ == 'SGDClassifier':
+        return {'log_loss': 'ovr', 'log': 'ovr', 'modified_huber': 'modified_huber'}.get(model.loss)
+    if type(model).__name__ not in ('LogisticRegression', 'LogisticRegressionCV'):
+        return None
+    ovr = model.multi_class in ('ovr', 'warn') or (model.multi_class == 'auto' and (model.classes_.size <= 2 or model.solver == 'liblinear'))
+    return 'ovr' if ovr else 'softmax'
+
+
+def export_svc(model, spec, arrays, prefix):
+    '''
+    libsvm decides between classes i < j with sum(coef[j-1, sv] K(sv, x) for sv of i) + sum(coef[i, sv] K(sv, x) for sv of j) + b.
+    Those coefficients are laid out as one column per pair so all the decisions are K(x, SV) @ pair_coef + b.
+    '''
+    dual_coef, intercept = model._dual_coef_, model._intercept_
+    n_classes = len(model.classes_)
+    starts = np.concatenate([[0], np.cumsum(model._n_support)])
+    pair_coef = np.zeros((len(model.support_vectors_), n_classes * (n_classes - 1) // 2))
+    p = 0
+    for i in range(n_classes):
+        for j in range(i + 1, n_classes):
+            pair_coef[starts[i]:starts[i+1], p] = dual_coef[j-1, starts[i]:starts[i+1]]
+            pair_coef[starts[j]:starts[j+1], p] = dual_coef[i, starts[j]:starts[j+1]]
+            p += 1
+    arrays[f'{prefix}.support_vectors'] = np.asarray(model.support_vectors_, dtype=np.float64)
+    arrays[f'{prefix}.pair_coef'] = pair_coef
+    arrays[f'{prefix}.intercept'] = np.asarray(intercept, dtype=np.float64)
+    spec.update({'support_vectors': f'{prefix}.support_vectors', 'pair_coef': f'{prefix}.pair_coef', 'intercept': f'{prefix}.intercept',
+                 'kernel': model.kernel, 'gamma': float(model._gamma), 'coef0': float(model.coef0), 'degree': int(model.degree),
+                 'decision_function_shape': model.decision_function_shape})
+    if model.kernel not in ('linear', 'rbf', 'poly', 'sigmoid'):
+        raise ValueError(f'SVC with a {model.kernel} kernel can not be exported')
+    if model.probability:
+        # the sigmoid (Platt scaling) fitted on the decision of each pair
+        arrays[f'{prefix}.probA'] = np.asarray(model.probA_, dtype=np.float64)
+        arrays[f'{prefix}.probB'] = np.asarray(model.probB_, dtype=np.float64)
+        spec['probA'], spec['probB'] = f'{prefix}.probA', f'{prefix}.probB'
+
+
+def export_trees(trees, arrays, prefix):
+    '''
+    Concatenates the nodes of the trees into flat arrays: children[2*node] and children[2*node + 1] are the global indices
+    of the left and right child (a leaf is its own child so walking past it stays on it), and value holds the leaf values
+    normalized into class probabilities as DecisionTreeClassifier.predict_proba does.
+    sklearn compares float32 features with float64 thresholds, so each threshold is rounded down to the largest float32 not
+    above it: the comparison stays the same and can be made in float32.
+    '''
+    offsets = np.concatenate([[0], np.cumsum([tree.tree_.node_count for tree in trees])])
+    children, feature, threshold, value = [], [], [], []
+    for offset, tree in zip(offsets, trees):
+        t = tree.tree_
+        nodes = np.arange(t.node_count) + offset
+        leaf = t.children_left < 0
+        children.append(np.stack([np.where(leaf, nodes, t.children_left + offset), np.where(leaf, nodes, t.children_right + offset)], axis=1))
+        feature.append(np.where(leaf, 0, t.feature))
+        threshold.append(t.threshold)
+        proba = t.value[:, 0, :].astype(np.float64)
+        normalizer = proba.sum(axis=1)
+        normalizer[normalizer == 0.0] = 1.0
+        value.append(proba / normalizer[:, None])
+    arrays[f'{prefix}.trees.children'] = np.concatenate(children).ravel().astype(np.intp)
+    arrays[f'{prefix}.trees.feature'] = np.concatenate(feature).astype(np.intp)
+    threshold = np.concatenate(threshold)
+    rounded = threshold.astype(np.float32)
+    arrays[f'{prefix}.trees.threshold'] = np.where(rounded > threshold, np.nextafter(rounded, np.float32(-np.inf)), rounded)
+    arrays[f'{prefix}.trees.value'] = np.concatenate(value)
+    arrays[f'{prefix}.trees.roots'] = offsets[:-1].astype(np.intp)
+    classes = np.stack([np.asarray(tree.classes_) for tree in trees])
+    arrays[f'{prefix}.trees.classes'] = classes.astype(str) if classes.dtype == object else classes
+    return {'prefix': f'{prefix}.trees', 'max_depth': int(max(tree.tree_.max_depth for tree in trees))}
+
+
+#---------------------------------------------------------------------------------
+# Prediction
+
+def kernel(spec, x_data, support_vectors):
+    if spec['kernel'] == 'linear':
+        return x_data @ support_vectors.T
+    if spec['kernel'] == 'rbf':
+        distances = (x_data**2).sum(axis=1)[:, None] - 2 * x_data @ support_vectors.T + (support_vectors**2).sum(axis=1)[None, :]
+        return np.exp(-spec['gamma'] * np.maximum(distances, 0))
+    dot = spec['gamma'] * (x_data @ support_vectors.T) + spec['coef0']
+    return dot**spec['degree'] if spec['kernel'] == 'poly' else np.tanh(dot)
+
+
+def ovr_decision(decision, n_classes):
+    '''
+    sklearn's one-vs-rest shaped decision of an SVC: the votes of the pairwise decisions plus their scaled confidences.
+    '''
+    votes = np.zeros((len(decision), n_classes))
+    confidences = np.zeros((len(decision), n_classes))
+    p = 0
+    for i in range(n_classes):
+        for j in range(i + 1, n_classes):
+            confidences[:, i] += decision[:, p]
+            confidences[:, j] -= decision[:, p]
+            votes[decision[:, p] >= 0, i] += 1
+            votes[decision[:, p] < 0, j] += 1
+            p += 1
+    return votes + confidences / (3 * (np.abs(confidences) + 1))
+
+
+def svc_proba(spec, arrays, decision, n_classes):
+    '''
+    libsvm's probabilities of an SVC: the pairwise probabilities given by the sigmoid of each pair's decision are coupled into
+    class probabilities with the iterative method of Wu, Lin and Weng (2004), run for all the rows at once (the libsvm of
+    sklearn couples two classes this way as well).
+    '''
+    fApB = decision * arrays[spec['probA']] + arrays[spec['probB']]
+    # the two forms of the sigmoid libsvm uses to avoid overflows
+    pairwise = np.where(fApB >= 0, np.exp(-np.abs(fApB)) / (1 + np.exp(-np.abs(fApB))), 1 / (1 + np.exp(-np.abs(fApB))))
+    pairwise = np.clip(pairwise, 1e-7, 1 - 1e-7)
+    # r[:, i, j] is the probability of class i against class j
+    n, k = len(decision), n_classes
+    r = np.zeros((n, k, k))
+    p = 0
+    for i in range(k):
+        for j in range(i + 1, k):
+            r[:, i, j], r[:, j, i] = pairwise[:, p], 1 - pairwise[:, p]
+            p += 1
+    Q = -r.transpose(0, 2, 1) * r
+    Q[:, np.arange(k), np.arange(k)] = (r**2).sum(axis=1)
+    proba = np.full((n, k), 1 / k)
+    active = np.ones(n, dtype=bool)
+    for _ in range(max(100, k)):
+        Qp = np.einsum('nij,nj->ni', Q, proba)
+        pQp = (proba * Qp).sum(axis=1)
+        active &= np.abs(Qp - pQp[:, None]).max(axis=1) >= 0.005 / k
+        if not active.any(): break
+        for t in range(k):
+            diff = np.where(active, (pQp - Qp[:, t]) / Q[:, t, t], 0)
+            proba[:, t] += diff
+            pQp = (pQp + diff * (diff * Q[:, t, t] + 2 * Qp[:, t])) / (1 + diff)**2
+            Qp = (Qp + diff[:, None] * Q[:, t, :]) / (1 + diff)[:, None]
+            proba /= (1 + diff)[:, None]
+    return proba
+
+
+def forest_proba(forest, arrays, x_data):
+    '''
+    The class probabilities of every tree for every row, shape (rows, trees, classes), walking all the trees level by level.
+    '''
+    prefix = forest['prefix']
+    children, feature, threshold = arrays[f'{prefix}.children'], arrays[f'{prefix}.feature'], arrays[f'{prefix}.threshold']
+    value, roots = arrays[f'{prefix}.value'], arrays[f'{prefix}.roots']
+    x_data = x_data.astype(np.float32)
+    # offset of each row in the flattened x_data, to pick x[row, feature[node]] with a single take
+    rows = (np.arange(len(x_data)) * x_data.shape[1])[:, None]
+    nodes = np.repeat(roots[None, :], len(x_data), axis=0)
+    for _ in range(forest['max_depth']):
+        right = x_data.take(rows + feature.take(nodes)) > threshold.take(nodes)
+        nodes = children.take(2 * nodes + right)
+    return value[nodes]
+
+
+def evaluate(spec, arrays, x_data, method):
+    '''
+    The predict, predict_proba or decision_function (method) of the exported model on a float64 matrix.
+    '''
+    kind = spec['type']
+    classes = arrays[spec['classes']] if 'classes' in spec else None
+    if kind == 'StackingClassifier':
+        x_final = stack_features(spec, arrays, x_data)
+        if method == 'predict':
+            return classes[evaluate(spec['final'], arrays, x_final, 'predict')]
+        return evaluate(spec['final'], arrays, x_final, method)
+
+    if kind == 'SVC':
+        decision = kernel(spec, x_data, arrays[spec['support_vectors']]) @ arrays[spec['pair_coef']] + arrays[spec['intercept']]
+        if method == 'predict':
+            # libsvm's vote: decision > 0 votes for the first class of the pair
+            if len(classes) == 2: return classes[(decision[:, 0] <= 0).astype(int)]
+            votes = np.zeros((len(x_data), len(classes)), dtype=np.int64)
+            p = 0
+            for i in range(len(classes)):
+                for j in range(i + 1, len(classes)):
+                    votes[:, i] += decision[:, p] > 0
+                    votes[:, j] += decision[:, p] <= 0
+                    p += 1
+            return classes[np.argmax(votes, axis=1)]
+        if method == 'decision_function':
+            if len(classes) == 2: return -decision[:, 0]
+            return ovr_decision(decision, len(classes)) if spec['decision_function_shape'] == 'ovr' else decision
+        if 'probA' not in spec:
+            raise ValueError('the exported SVC was trained without probability=True')
+        return svc_proba(spec, arrays, decision, len(classes))
+
+    if kind == 'linear':
+        decision = x_data @ arrays[spec['coef']].T + arrays[spec['intercept']]
+        if decision.shape[1] == 1: decision = decision[:, 0]
+        if method == 'decision_function':
+            return decision
+        if method == 'predict':
+            return classes[(decision > 0).astype(int)] if decision.ndim == 1 else classes[np.argmax(decision, axis=1)]
+        if spec['proba'] == 'softmax':
+            decision = decision.reshape(len(x_data), -1)
+            if decision.shape[1] == 1: decision = np.hstack([-decision, decision])
+            proba = np.exp(decision - decision.max(axis=1, keepdims=True))
+            return proba / proba.sum(axis=1, keepdims=True)
+        if spec['proba'] == 'ovr':
+            proba = 1 / (1 + np.exp(-decision))
+            if proba.ndim == 1: return np.c_[1 - proba, proba]
+            return proba / proba.sum(axis=1, keepdims=True)
+        if spec['proba'] == 'modified_huber':
+            proba = (np.clip(decision, -1, 1) + 1) / 2
+            if proba.ndim == 1: return np.c_[1 - proba, proba]
+            total = proba.sum(axis=1, keepdims=True)
+            # rows where every class got 0 are given uniform probabilities
+            proba[total[:, 0] == 0] = 1
+            return proba / np.where(total == 0, len(classes), total)
+        raise ValueError(f'{spec["model"]} has no predict_proba')
+
+    # the trees are walked TREE_BLOCK rows at a time to bound the (rows, trees) matrices
+    return np.concatenate([evaluate_trees(spec, arrays, x_data[lo:lo+TREE_BLOCK], method)
+                           for lo in range(0, max(len(x_data), 1), TREE_BLOCK)])
+
+
+def evaluate_trees(spec, arrays, x_data, method):
+    '''
+    evaluate for the tree models (a tree, a forest or AdaBoost).
+    '''
+    kind = spec['type']
+    classes = arrays[spec['classes']]
+    probas = forest_proba(spec['forest'], arrays, x_data)
+    if kind == 'DecisionTreeClassifier':
+        proba = probas[:, 0]
+    elif kind == 'forest':
+        # summed tree by tree in the same order as sklearn
+        proba = np.zeros((len(x_data), probas.shape[2]))
+        for t in range(probas.shape[1]):
+            proba += probas[:, t]
+        proba /= probas.shape[1]
+    elif kind == 'AdaBoostClassifier':
+        weights = arrays[spec['weights']]
+        n_classes = len(classes)
+        decision = 0
+        for t in range(probas.shape[1]):
+            if spec['algorithm'] == 'SAMME.R':
+                log_proba = np.log(np.clip(probas[:, t], np.finfo(np.float64).eps, None))
+                decision = decision + (n_classes - 1) * (log_proba - log_proba.sum(axis=1, keepdims=True) / n_classes)
+            else:
+                tree_classes = arrays[f'{spec["forest"]["prefix"]}.classes'][t]
+                decision = decision + (tree_classes[np.argmax(probas[:, t], axis=1)][:, None] == classes[None, :]) * weights[t]
+        decision = decision / weights.sum()
+        if n_classes == 2:
+            decision[:, 0] *= -1
+            decision = decision.sum(axis=1)
+        if method == 'decision_function': return decision
+        if method == 'predict':
+            return classes[(decision > 0).astype(int)] if n_classes == 2 else classes[np.argmax(decision, axis=1)]
+        decision = np.vstack([-decision, decision]).T / 2 if n_classes == 2 else decision / (n_classes - 1)
+        proba = np.exp(decision - decision.max(axis=1, keepdims=True))
+        return proba / proba.sum(axis=1, keepdims=True)
+    if method == 'predict':
+        return classes[np.argmax(proba, axis=1)]
+    if method == 'predict_proba':
+        return proba
+    raise ValueError(f'{kind} has no decision_function')
+
+
+class LeanPredictor:
+    '''
+    Predicts with an exported model: model.predict(x), model.decision_function(x) and model.predict_proba(x) take a
+    DataFrame (its columns are put in the order the model was fitted with) or a matrix.
+    '''
+    def __init__(self, spec, arrays):
+        self.spec = spec
+        self.arrays = arrays
+        self.classes_ = arrays[spec['classes']]
+
+    def matrix(self, x_test):
+        if isinstance(x_test, pd.DataFrame) and 'features' in self.spec:
+            x_test = x_test[self.spec['features']]
+        return np.asarray(x_test, dtype=np.float64)
+
+    def predict(self, x_test):
+        return evaluate(self.spec, self.arrays, self.matrix(x_test), 'predict')
+
+    def decision_function(self, x_test):
+        return evaluate(self.spec, self.arrays, self.matrix(x_test), 'decision_function')
+
+    def predict_proba(self, x_test):
+        return evaluate(self.spec, self.arrays, self.matrix(x_test), 'predict_proba')
+
+    def predict_scores(self, x_test):
+        '''
+        The predictions with the probabilities of the model (or its decision scores when it has none) and whether they are
+        probabilities. The base estimators of a stacking model are evaluated only once for both.
+        '''
+        spec, x_test = self.spec, self.matrix(x_test)
+        if spec['type'] == 'StackingClassifier':
+            final = spec['final']
+            x_final = stack_features(spec, self.arrays, x_test)
+            labels = self.classes_[evaluate(final, self.arrays, x_final, 'predict')]
+            method = 'predict_proba' if self.has_proba(final) else 'decision_function'
+            return labels, evaluate(final, self.arrays, x_final, method), method == 'predict_proba'
+        method = 'predict_proba' if self.has_proba(spec) else 'decision_function'
+        return evaluate(spec, self.arrays, x_test, 'predict'), evaluate(spec, self.arrays, x_test, method), method == 'predict_proba'
+
+    @staticmethod
+    def has_proba(spec):
+        return spec['type'] in ('forest', 'DecisionTreeClassifier', 'AdaBoostClassifier') or spec['type'] == 'linear' and spec['proba'] is not None \
+            or spec['type'] == 'SVC' and 'probA' in spec
+
+    def save(self, path):
+        '''
+        Saves the spec and the names of the arrays (spec.json) and every array as an uncompressed {name}.npy into the directory path.
+        '''
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'spec.json'), 'w') as f:
+            json.dump({'spec': self.spec, 'arrays': sorted(self.arrays)}, f)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(path, f'{name}.npy'), array)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Loads a saved LeanPredictor; the arrays are memory-mapped rather than read into memory.
+        '''
+        with open(os.path.join(path, 'spec.json')) as f:
+            saved = json.load(f)
+        # plain ndarray views of the maps (np.memmap adds overhead to every operation)
+        arrays = {name: np.asarray(np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)) for name in saved['arrays']}
+        return cls(saved['spec'], arrays)
+
+
+def stack_features(spec, arrays, x_data):
+    '''
+    The inputs of the final estimator of an exported StackingClassifier.
+    '''
+    classes = arrays[spec['classes']]
+    features = []
+    for estimator, stack_method in zip(spec['estimators'], spec['stack_method']):
+        if estimator is None: continue
+        prediction = evaluate(estimator, arrays, x_data, stack_method)
+        if stack_method == 'predict_proba' and len(classes) == 2:
+            prediction = prediction[:, 1:]
+        features.append(prediction.reshape(len(x_data), -1))
+    if spec['passthrough']: features.append(x_data)
+    return np.hstack(features)
+
+
+def compile_model(model):
+    '''
+    Exports a fitted model into a LeanPredictor.
+    '''
+    spec, arrays = export(model)
+    return LeanPredictor(spec, arrays)
+
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from ModelScoring.Pipeline import load_model
+    parser = argparse.ArgumentParser(description='Export a pickled model into a NumPy-only representation.')
+    parser.add_argument('--model', default='StackingEnsemble.pkl', help='pickled model to export')
+    parser.add_argument('--output', default='StackingEnsembleLean', help='directory to write the exported model to')
+    args = parser.parse_args()
+    compile_model(load_model(args.model, lean=False)).save(args.output)
+    start = time.perf_counter()
+    LeanPredictor.load(args.output)
+    print(f'Exported {args.model} to {args.output} (loads in {(time.perf_counter() - start) * 1000:.1f} ms)')
@@ -1,61 +1,186 @@
 '''
 The final pipeline goes here (competition model) and its evaluation.
 '''
-import pickle 
+import argparse
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..'))
+from DataPreparation.Preprocessor import Preprocessor
+from ModelScoring.Compiled import LeanPredictor
+from ModelScoring import Registry
 
-def read_sample():
-    '''
-    A read_sample function for when the model is to be evaluated
-    '''
-
-    x_data = pd.read_csv('test.csv')
+BODY_LEVELS = np.array(['Body Level 1', 'Body Level 2', 'Body Level 3', 'Body Level 4'])
+# the competition model, registered in Saved/Cache/Models (see Registry.register) the first time it is loaded
+MODEL = os.path.join(HERE, 'StackingEnsemble.pkl')
 
-    # extract only the numerical features
-    cont_feats = [feat for feat in x_data.columns if type(x_data.iloc[0, x_data.columns.get_loc(feat)]) != str]
-    x_data = x_data[cont_feats]
-    for feat in x_data.columns:
-        x_data[feat] = x_data[feat].astype(float)
 
-    # standardize the numerical features
-    means=[24.30154547138047, 1.7044246599326598, 86.24393004377106, 2.4137310067340065, 1.9985143434343435, 2.603423063973064, 1.0657414511784513, 0.6401021212121212] 
-    stds=[6.187403093300774, 0.09328631635951697, 25.765476944060072, 0.5586174649270286, 0.6404876859634282, 0.8226938923003604, 0.8170331197353868, 0.5959943002074906,0.98989898989899]
-    for i,feat in enumerate(x_data.columns):
-        x_data[feat] = (x_data[feat] - means[i])/stds[i]
+def read_sample(preprocessor, path='test.csv', chunksize=None):
+    '''
+    A read_sample function for when the model is to be evaluated.
+    The features are standardized with the fitted preprocessor so the result does not depend on the batch.
+    If chunksize is given, it returns an iterator over standardized chunks of at most chunksize rows.
+    '''
+    reader = pd.read_csv(path, usecols=preprocessor.columns, dtype=preprocessor.dtypes, chunksize=chunksize)
+    if chunksize is None:
+        return preprocessor.transform(reader[preprocessor.columns])
+    return (preprocessor.transform(chunk[preprocessor.columns]) for chunk in reader)
 
-    return x_data
+def load_preprocessor(preprocessor_path):
+    '''
+    Loads the fitted preprocessor (column order, dtypes, means and stds) the model was trained with.
+    '''
+    return Preprocessor.load(preprocessor_path)
 
-def load_model(model_path):
+def load_model(model_path, lean=True):
     '''
-    Loads the model from the given path.
+    Loads the model from the given path: a model registry directory (its NumPy-only export if lean and it has one),
+    the directory of a model exported by Compiled.py or a pickle (loaded from its registry entry, created if needed).
     '''
-    with open(model_path, 'rb') as f:
-        model = pickle.load(f)
-    return model
+    if os.path.isfile(model_path):
+        model_path = Registry.register(model_path)
+    if os.path.isfile(os.path.join(model_path, 'manifest.json')):
+        return Registry.load(model_path, lean=lean and Registry.read_manifest(model_path)['lean'])
+    return LeanPredictor.load(model_path)
 
 def predict(model, x_test):
     '''
     Predicts the target variable for the given data.
     '''
     y_test = model.predict(x_test)
-    body_levels = ['Body Level 1', 'Body Level 2', 'Body Level 3', 'Body Level 4']
-    y_pred = [body_levels[i] for i in y_test]
-    return y_pred
+    return BODY_LEVELS[y_test]
+
+def predict_scores(model, x_test):
+    '''
+    Predicts the target variable for the given data along with the probability of each Body Level.
+    Models that can not estimate probabilities (the final SVC of the StackingEnsemble was trained without probability=True)
+    give the decision score of each level instead. Returns the labels, the scores and whether they are probabilities.
+    '''
+    if isinstance(model, LeanPredictor):
+        y_test, scores, is_proba = model.predict_scores(x_test)
+        return BODY_LEVELS[y_test], scores, is_proba
+    if hasattr(model, 'final_estimator_'):
+        # run the base estimators once for both the predictions and the scores (the final estimator predicts class indices)
+        classes = model.classes_
+        x_test, model = model.transform(x_test), model.final_estimator_
+        y_test = classes[model.predict(x_test)]
+    else:
+        y_test = model.predict(x_test)
+    if hasattr(model, 'predict_proba'):
+        return BODY_LEVELS[y_test], model.predict_proba(x_test), True
+    return BODY_LEVELS[y_test], model.decision_function(x_test), False
+
+def pipeline(input_path='test.csv', model_path=MODEL, output_path='preds.txt', chunksize=100_000,
+             preprocessor_path=os.path.join(HERE, 'Preprocessor')):
+    '''
+    Scores input_path chunk by chunk and streams the predicted labels to output_path (one per line).
+    Only one chunk is held in memory at a time. Returns the number of scored rows.
+    '''
+    model = load_model(model_path)
+    preprocessor = load_preprocessor(preprocessor_path)
+    n_rows = 0
+    with open(output_path, 'w') as f:
+        for x_test in read_sample(preprocessor, input_path, chunksize=chunksize):
+            if len(x_test) == 0: continue
+            y_pred = predict(model, x_test)
+            # no trailing newline after the last prediction
+            if n_rows > 0: f.write('\n')
+            f.write('\n'.join(y_pred))
+            n_rows += len(x_test)
+    return n_rows
+
+def shard_offsets(path, shard_bytes=8 << 20):
+    '''
+    returns the csv header and the (start, end) byte ranges of shards of about shard_bytes that begin and end on row
+    boundaries (rows must not contain newlines). Only one seek per shard is needed, the rows are never counted.
+    '''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.readline().decode().strip().split(',')
+        bounds = [f.tell()]
+        while bounds[-1] + shard_bytes < size:
+            f.seek(bounds[-1] + shard_bytes)
+            f.readline()
+            if f.tell() >= size: break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return header, [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+# the model and the preprocessor of a scoring worker, loaded once by init_worker
+WORKER = {}
+
+def init_worker(model_path, preprocessor_path):
+    '''
+    Loads the model (memory-mapped, so all the workers share the pages of its weights) and the preprocessor in a worker.
+    Each worker uses a single BLAS thread since the parallelism comes from the workers.
+    '''
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(1)
+    WORKER['model'] = load_model(model_path)
+    WORKER['preprocessor'] = load_preprocessor(preprocessor_path)
 
+def score_shard(task):
+    '''
+    Scores the rows between the byte offsets start and end of a csv file and returns the index of each predicted Body Level.
+    '''
+    path, header, start, end = task
+    preprocessor = WORKER['preprocessor']
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    x_test = pd.read_csv(io.BytesIO(data), header=None, names=header, usecols=preprocessor.columns, dtype=preprocessor.dtypes)
+    return np.asarray(WORKER['model'].predict(preprocessor.transform(x_test[preprocessor.columns])), dtype=np.int8)
 
-# Read the data
-x_test = read_sample()
+def parallel_pipeline(input_paths, output_paths, model_path=MODEL, workers=None,
+                      shard_bytes=8 << 20, preprocessor_path=os.path.join(HERE, 'Preprocessor')):
+    '''
+    Scores each of input_paths into the matching output path with a pool of workers (os.cpu_count() by default).
+    The files are cut into row-aligned shards of about shard_bytes that are scored by whichever worker is free, and the
+    predictions are written back in order. The model is loaded from the registry by memory-mapping, so the workers share
+    one read-only copy of its weights (a pickled model is registered first).
+    Returns the number of scored rows.
+    '''
+    if os.path.isfile(model_path):
+        model_path = Registry.register(model_path)
+    shards = [shard_offsets(path, shard_bytes) for path in input_paths]
+    tasks = [(path, header, start, end) for path, (header, ranges) in zip(input_paths, shards) for start, end in ranges]
+    n_rows = 0
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(model_path, preprocessor_path)) as pool:
+        results = pool.map(score_shard, tasks)
+        for output_path, (_, ranges) in zip(output_paths, shards):
+            with open(output_path, 'w') as f:
+                for i in range(len(ranges)):
+                    y_pred = BODY_LEVELS[next(results)]
+                    # no trailing newline after the last prediction
+                    if i > 0: f.write('\n')
+                    f.write('\n'.join(y_pred))
+                    n_rows += len(y_pred)
+    return n_rows
 
-# Load the model
-model = load_model('StackingEnsemble.pkl')
 
-# Predict the target variable
-y_pred = predict(model, x_test)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score a csv file with the competition model.')
+    parser.add_argument('--input', nargs='+', default=['test.csv'], help='csv files with the features to score')
+    parser.add_argument('--model', default=MODEL, help='pickled model (registered on first use) or model registry directory to use')
+    parser.add_argument('--output', nargs='+', default=None,
+                        help='where to write the predicted labels of each input (default: preds.txt, or <input>_preds.txt for several inputs)')
+    parser.add_argument('--chunksize', type=int, default=100_000, help='number of rows scored at a time')
+    parser.add_argument('--preprocessor', default=os.path.join(HERE, 'Preprocessor'), help='directory of the fitted preprocessor')
+    parser.add_argument('--workers', type=int, default=1, help='number of scoring processes (0 for one per core)')
+    parser.add_argument('--shard-mb', type=float, default=8, help='size of the pieces of the inputs handed to the workers')
+    args = parser.parse_args()
+    outputs = args.output or (['preds.txt'] if len(args.input) == 1 else [f'{os.path.splitext(path)[0]}_preds.txt' for path in args.input])
+    if len(outputs) != len(args.input): parser.error('give one --output per --input')
 
-# write the predictions to a txt file
-with open('preds.txt', 'w') as f:
-    for i, item in enumerate(y_pred):
-        if i == len(y_pred) - 1:
-            f.write("%s" % item)
-        else:
-            f.write("%s\n" % item)
\ No newline at end of file
+    start = time.perf_counter()
+    if args.workers == 1:
+        n_rows = sum(pipeline(path, args.model, output, args.chunksize, args.preprocessor) for path, output in zip(args.input, outputs))
+    else:
+        n_rows = parallel_pipeline(args.input, outputs, args.model, args.workers or None, int(args.shard_mb * 2**20), args.preprocessor)
+    duration = time.perf_counter() - start
+    print(f'Scored {n_rows} rows in {duration:.2f}s ({n_rows / max(duration, 1e-9):.0f} rows/s)')
@@ -0,0 +1,203 @@
+'''
+The model registry: a saved model is a directory instead of a single pickle.
+    <registry>/<name>/manifest.json     format, library versions, class of the model, feature schema and checksums
+    <registry>/<name>/model.pkl         the estimator with every large array taken out (a small skeleton)
+    <registry>/<name>/arrays/<i>.npy    those arrays, uncompressed, memory-mapped back on load
+    <registry>/<name>/lean/             the NumPy-only export of the model (see Compiled.py) when it has one
+The registry is Saved/ at the root of the repository unless the BODY_LEVEL_REGISTRY environment variable points elsewhere.
+Memory-mapped arrays live in the page cache, so every process that loads the same model shares one copy of its weights.
+The scoring pipeline registers the pickled model it is given on first use, under <registry>/Cache/Models (see register).
+To convert a pickled model:
+    python Registry.py --model StackingEnsemble.pkl --output StackingEnsemble
+'''
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import platform
+import shutil
+import sys
+import time
+import warnings
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ModelScoring.Compiled import LeanPredictor, compile_model
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REGISTRY = os.path.abspath(os.environ.get('BODY_LEVEL_REGISTRY', os.path.join(ROOT, 'Saved')))
+FORMAT = 1
+# arrays smaller than this (in bytes) stay inside the skeleton pickle
+MIN_BLOB = 1024
+
+
+def model_path(name, registry=None):
+    '''
+    The absolute path of the directory of the model called name in the registry.
+    '''
+    return os.path.join(os.path.abspath(registry or REGISTRY), name)
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class BlobPickler(pickle.Pickler):
+    '''
+    Pickles an estimator while writing each of its large numeric arrays to its own .npy file in directory.
+    '''
+    def __init__(self, file, directory):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.directory = directory
+        self.blobs = []
+
+    def persistent_id(self, obj):
+        if type(obj) not in (np.ndarray, np.memmap) or obj.dtype.hasobject or obj.nbytes < MIN_BLOB:
+            return None
+        name = f'arrays/{len(self.blobs)}.npy'
+        np.save(os.path.join(self.directory, name), np.asarray(obj))
+        self.blobs.append(name)
+        return name
+
+
+class BlobUnpickler(pickle.Unpickler):
+    '''
+    Unpickles a skeleton written by BlobPickler, memory-mapping its arrays back.
+    '''
+    def __init__(self, file, directory, mmap_mode='r'):
+        super().__init__(file)
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+
+    def persistent_load(self, name):
+        return np.load(os.path.join(self.directory, name), mmap_mode=self.mmap_mode)
+
+
+def versions():
+    import sklearn
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'sklearn': sklearn.__version__}
+
+
+def schema(model):
+    '''
+    The features (in order) and the classes the model was fitted with.
+    '''
+    schema = {}
+    if hasattr(model, 'feature_names_in_'): schema['features'] = [str(feat) for feat in model.feature_names_in_]
+    if hasattr(model, 'n_features_in_'): schema['n_features'] = int(model.n_features_in_)
+    if hasattr(model, 'classes_'): schema['classes'] = np.asarray(model.classes_).tolist()
+    return schema
+
+
+def save(model, path, lean=True):
+    '''
+    Saves model into the directory path (created or replaced) and returns its manifest.
+    The directory is written next to path then swapped in, so readers never see a half-written model.
+    If lean, the NumPy-only export of the model is saved too (when the model can be exported, else it is left out).
+    '''
+    path = os.path.abspath(path)
+    tmp = f'{path}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(os.path.join(tmp, 'arrays'))
+    with open(os.path.join(tmp, 'model.pkl'), 'wb') as f:
+        BlobPickler(f, tmp).dump(model)
+    has_lean = False
+    if lean:
+        try:
+            compile_model(model).save(os.path.join(tmp, 'lean'))
+            has_lean = True
+        except (ValueError, AttributeError):
+            # the model is still saved for sklearn, only without a NumPy-only export
+            shutil.rmtree(os.path.join(tmp, 'lean'), ignore_errors=True)
+    files = sorted(os.path.relpath(os.path.join(folder, file), tmp).replace(os.sep, '/')
+                   for folder, _, names in os.walk(tmp) for file in names)
+    checksums = {file: sha256(os.path.join(tmp, file)) for file in files}
+    manifest = {'format': FORMAT, 'model': f'{type(model).__module__}.{type(model).__name__}',
+                'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                'versions': versions(), 'schema': schema(model), 'lean': has_lean, 'files': checksums,
+                'checksum': hashlib.sha256(json.dumps(checksums, sort_keys=True).encode()).hexdigest()}
+    with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    if os.path.isdir(path):
+        os.replace(path, f'{tmp}.old')
+    os.replace(tmp, path)
+    shutil.rmtree(f'{tmp}.old', ignore_errors=True)
+    return manifest
+
+
+def register(pickle_path, registry=None):
+    '''
+    The path of the registry entry of a pickled model, converted the first time it is asked for.
+    The entry is derived from the pickle, so it is kept with the other caches (<registry>/Cache/Models) and named after the
+    pickle and its checksum: an updated pickle gets a new entry instead of a stale one.
+    '''
+    name = f'{os.path.splitext(os.path.basename(pickle_path))[0]}-{sha256(pickle_path)[:12]}'
+    path = os.path.join(os.path.abspath(registry or REGISTRY), 'Cache', 'Models', name)
+    if not os.path.isfile(os.path.join(path, 'manifest.json')):
+        with open(pickle_path, 'rb') as f:
+            model = pickle.load(f)
+        save(model, path)
+    return path
+
+
+def read_manifest(path):
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != FORMAT:
+        raise ValueError(f'{path} has format {manifest.get("format")}, expected {FORMAT}')
+    return manifest
+
+
+def verify(path, files=None):
+    '''
+    Checks the files of the saved model (all of them by default) against the checksums of its manifest.
+    Raises ValueError on the first mismatch.
+    '''
+    manifest = read_manifest(path)
+    for file in manifest['files'] if files is None else files:
+        if file not in manifest['files']:
+            raise ValueError(f'{file} is not part of {path}')
+        if sha256(os.path.join(path, file)) != manifest['files'][file]:
+            raise ValueError(f'{os.path.join(path, file)} does not match the checksum of its manifest')
+    return manifest
+
+
+def load(path, lean=False, mmap_mode='r', check=False):
+    '''
+    Loads the model saved in the directory path.
+    If lean, its NumPy-only export is returned instead (a LeanPredictor, which does not even import sklearn).
+    The small files (the skeleton pickle or the lean spec) are always checked against the manifest before being read, the
+    arrays only if check (it reads them all, which memory-mapping otherwise avoids).
+    '''
+    path = os.path.abspath(path)
+    manifest = read_manifest(path)
+    if lean:
+        if not manifest['lean']:
+            raise ValueError(f'{path} has no NumPy-only export')
+        verify(path, [file for file in manifest['files'] if file.startswith('lean/') and (check or file.endswith('.json'))])
+        return LeanPredictor.load(os.path.join(path, 'lean'), mmap_mode)
+    verify(path, [file for file in manifest['files'] if check or file == 'model.pkl'])
+    import sklearn
+    if manifest['versions']['sklearn'] != sklearn.__version__:
+        warnings.warn(f'{path} was saved with sklearn {manifest["versions"]["sklearn"]} but {sklearn.__version__} is installed')
+    with open(os.path.join(path, 'model.pkl'), 'rb') as f:
+        return BlobUnpickler(f, path, mmap_mode).load()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a pickled model into the model registry format.')
+    parser.add_argument('--model', default='StackingEnsemble.pkl', help='pickled model to convert')
+    parser.add_argument('--output', default=None, help='directory to save it to (default: the registry entry of the same name)')
+    args = parser.parse_args()
+    with open(args.model, 'rb') as f:
+        model = pickle.load(f)
+    output = args.output or model_path(os.path.splitext(os.path.basename(args.model))[0])
+    manifest = save(model, output)
+    start = time.perf_counter()
+    load(output, lean=manifest['lean'])
+    print(f'Saved {args.model} to {os.path.abspath(output)} ({len(manifest["files"])} files, loads in {(time.perf_counter() - start) * 1000:.1f} ms)')
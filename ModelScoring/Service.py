@@ -0,0 +1,122 @@
+'''
+A long-running HTTP service around the competition model:
+    python Service.py --port 5000
+- POST /predict: a JSON record, a JSON list of records (or {"records": [...]}) or a CSV batch (Content-Type: text/csv).
+  Returns the Body Level of each record with the probability (or decision score) of each level.
+- GET /metrics: latency percentiles and throughput counters.
+- GET /health
+The model and the preprocessor are loaded once at startup, and concurrent requests are gathered by a BatchScheduler into
+single calls to the model.
+'''
+import argparse
+import collections
+import functools
+import io
+import os
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+from flask import Flask, jsonify, request
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ModelScoring.Pipeline import HERE, MODEL, BODY_LEVELS, load_model, load_preprocessor, predict_scores
+from ModelScoring.Batching import BatchScheduler
+
+
+class Stats:
+    '''
+    Request, row and error counters and the latencies of the last window requests.
+    '''
+    def __init__(self, window=10_000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = self.rows = self.errors = 0
+        self.started = time.time()
+
+    def record(self, latency, rows=0, error=False):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.rows += rows
+            self.errors += error
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            uptime = time.time() - self.started
+            summary = {'requests': self.requests, 'rows': self.rows, 'errors': self.errors, 'uptime_s': uptime,
+                       'requests_per_s': self.requests / uptime, 'rows_per_s': self.rows / uptime}
+        for q in (50, 90, 99):
+            summary[f'latency_p{q}_ms'] = float(np.percentile(latencies, q)) if len(latencies) else None
+        summary['latency_max_ms'] = float(latencies.max()) if len(latencies) else None
+        return summary
+
+
+def read_records(preprocessor):
+    '''
+    The standardized features of the records in the request, and whether a single record (a JSON object) was sent.
+    '''
+    if request.mimetype == 'text/csv':
+        x_test = pd.read_csv(io.StringIO(request.get_data(as_text=True)), usecols=preprocessor.columns, dtype=preprocessor.dtypes)
+        single = False
+    else:
+        data = request.get_json(force=True)
+        single = isinstance(data, dict) and 'records' not in data
+        records = [data] if single else data['records'] if isinstance(data, dict) else data
+        # an empty batch gets an empty list of predictions, as an empty csv batch does
+        x_test = pd.DataFrame.from_records(records) if len(records) else pd.DataFrame(columns=preprocessor.columns)
+        missing = [feat for feat in preprocessor.columns if feat not in x_test.columns]
+        if missing: raise ValueError(f'missing features: {missing}')
+        x_test = x_test[preprocessor.columns].astype(preprocessor.dtypes)
+    return preprocessor.transform(x_test[preprocessor.columns]), single
+
+
+def create_app(model_path=MODEL, preprocessor_path=os.path.join(HERE, 'Preprocessor'),
+               max_rows=256, max_wait_ms=2.0):
+    '''
+    Loads the model and the preprocessor once and returns the Flask app that serves them.
+    '''
+    app = Flask(__name__)
+    preprocessor = load_preprocessor(preprocessor_path)
+    batcher = BatchScheduler(functools.partial(predict_scores, load_model(model_path)), max_rows, max_wait_ms)
+    stats = Stats()
+
+    @app.post('/predict')
+    def predict():
+        start = time.perf_counter()
+        try:
+            x_test, single = read_records(preprocessor)
+            labels, scores, is_proba = batcher.predict(x_test) if len(x_test) else ([], np.zeros((0, len(BODY_LEVELS))), True)
+        except Exception as error:
+            stats.record(time.perf_counter() - start, error=True)
+            return jsonify({'error': str(error)}), 400
+        key = 'probabilities' if is_proba else 'scores'
+        predictions = [{'label': label, key: dict(zip(BODY_LEVELS, map(float, row)))} for label, row in zip(labels, scores)]
+        stats.record(time.perf_counter() - start, len(predictions))
+        return jsonify(predictions[0] if single else {'predictions': predictions})
+
+    @app.get('/metrics')
+    def metrics():
+        summary = stats.summary()
+        summary['batches'] = batcher.batches
+        summary['mean_batch_rows'] = batcher.batched_rows / max(batcher.batches, 1)
+        return jsonify(summary)
+
+    @app.get('/health')
+    def health():
+        return jsonify({'status': 'ok'})
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the competition model over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--model', default=MODEL, help='pickled model (registered on first use) or model registry directory to serve')
+    parser.add_argument('--preprocessor', default=os.path.join(HERE, 'Preprocessor'), help='directory of the fitted preprocessor')
+    parser.add_argument('--max-rows', type=int, default=256, help='largest number of rows scored in one model call')
+    parser.add_argument('--max-wait-ms', type=float, default=2.0, help='longest time a request waits for others to join its batch')
+    args = parser.parse_args()
+    create_app(args.model, args.preprocessor, args.max_rows, args.max_wait_ms).run(args.host, args.port, threaded=True)
@@ -1,5 +1,10 @@
 import pickle
 import os
+from ModelPipelines.Metrics import metrics
+from ModelScoring import Registry
+
+# models, hyperparameters and search checkpoints go to the model registry (Saved/ unless BODY_LEVEL_REGISTRY says otherwise)
+SAVED = Registry.REGISTRY
 
 def nice_table(dict, title=''):
     '''
@@ -38,8 +43,8 @@ def load_hyperparameters(model_name):
     Given model name, it returns the hyperparameters found by hyperparameter search.
     '''
     # if file exists
-    if os.path.isfile(f'../../Saved/{model_name}_opt_params.pkl'):
-        with open(f'../../Saved/{model_name}_opt_params.pkl', 'rb') as f:
+    if os.path.isfile(f'{SAVED}/{model_name}_opt_params.pkl'):
+        with open(f'{SAVED}/{model_name}_opt_params.pkl', 'rb') as f:
             opt_params = pickle.load(f)
         return opt_params
     else:
@@ -49,25 +54,47 @@ def save_hyperparameters(model_name, opt_params):
     '''
     Given model name and hyperparameters, it saves the hyperparameters found by hyperparameter search.
     '''
-    with open(f'../../Saved/{model_name}_opt_params.pkl', 'wb') as f:
+    with open(f'{SAVED}/{model_name}_opt_params.pkl', 'wb') as f:
         pickle.dump(opt_params, f)
 
-def load_model(model_name):
+def load_search(model_name):
     '''
-    Given model name, it returns the model.
+    Given model name, it returns the checkpoint of its hyperparameter search (None if there is none).
     '''
-    if not os.path.isfile(f'../../Saved/{model_name}.pkl'):
+    if not os.path.isfile(f'{SAVED}/{model_name}_search.pkl'):
         return None
-    with open(f'../../Saved/{model_name}.pkl', 'rb') as f:
+    with open(f'{SAVED}/{model_name}_search.pkl', 'rb') as f:
+        search = pickle.load(f)
+    return search
+
+def save_search(model_name, search):
+    '''
+    Given model name and the state of its hyperparameter search, it checkpoints it (atomically, so an interrupted write
+    never corrupts the previous checkpoint).
+    '''
+    with open(f'{SAVED}/{model_name}_search.pkl.tmp', 'wb') as f:
+        pickle.dump(search, f)
+    os.replace(f'{SAVED}/{model_name}_search.pkl.tmp', f'{SAVED}/{model_name}_search.pkl')
+
+def load_model(model_name, lean=False):
+    '''
+    Given model name, it returns the model (its arrays are memory-mapped from the registry).
+    If lean, it returns its NumPy-only export instead. Models pickled before the registry are still loaded.
+    '''
+    path = Registry.model_path(model_name)
+    if os.path.isdir(path):
+        return Registry.load(path, lean=lean)
+    if not os.path.isfile(f'{SAVED}/{model_name}.pkl'):
+        return None
+    with open(f'{SAVED}/{model_name}.pkl', 'rb') as f:
         model = pickle.load(f)
     return model
 
 def save_model(model_name, model):
     '''
-    Given model name and model, it saves the model.
+    Given model name and model, it saves the model into the registry (see ModelScoring/Registry.py).
     '''
-    with open(f'../../Saved/{model_name}.pkl', 'wb') as f:
-        pickle.dump(model, f)
+    Registry.save(model, Registry.model_path(model_name))
         
 def get_metrics(report):
     '''
@@ -75,4 +102,11 @@ def get_metrics(report):
     '''
     acc, wf1 = report.split('\n')[-2].split()[3:5]
     acc, wf1 = float(acc), float(wf1)
-    return acc, wf1
\ No newline at end of file
+    return acc, wf1
+
+def metrics_from_predictions(y_true, y_pred):
+    '''
+    The accuracy and weighted F1 of get_metrics computed numerically from the true and predicted labels (no report needed).
+    '''
+    acc, wf1 = metrics(y_true, y_pred)
+    return float(acc), float(wf1)
\ No newline at end of file